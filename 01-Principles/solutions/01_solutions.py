@@ -91,3 +91,9 @@ def task_5():
 
     print(closed_l)
     print(method_l)
+
+    # fast doubling stays exact where the closed form has lost precision
+    from recurrence import fib, fib_array
+    print([round(fib_closed(i)) - fib(i) for i in range(70, 80)])
+    print(fib(10**6).bit_length(), "bits in F(10^6)")
+    print(fib_array(range(n)))
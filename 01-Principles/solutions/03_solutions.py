@@ -11,12 +11,23 @@ def task_1():
     def first_order(p, q, initial_val):
         return it.accumulate(it.repeat(initial_val), lambda s,_: p*s+q)
 
+    # jumping straight to a term, or all of the first k at once
+    from recurrence import first_order_term, first_order_terms
+    print(list(it.islice(first_order(2, 1, 0), 10)))
+    print(first_order_term(2, 1, 0, 1000))
+    print(first_order_terms(.5, 1., 0., 10))
+
 
 def task_2():
     def second_order(p, q, r, initial_values):
         intermediate = it.accumulate(it.repeat(initial_values), lambda s,_: (s[1], p*s[1] + q*s[0] + r))
         return map(lambda x: x[0], intermediate)
 
+    from recurrence import second_order_term, second_order_terms
+    print(list(it.islice(second_order(1, 1, 0, (0, 1)), 10)))
+    print(second_order_term(1, 1, 0, (0, 1), 1000))
+    print(second_order_terms(.5, .25, 1., (0., 1.), 10))
+
 
 def task_3():
     bases = ['A', 'C', 'G', 'T']
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:20:07 2026
+
+Fast evaluation of the Fibonacci numbers (task 5 of 01_solutions.py) and of the
+first and second order recurrences of 03_solutions.py.
+"""
+import math
+import numbers
+import itertools as it
+from functools import lru_cache
+import numpy as np
+from scipy.signal import lfilter, lfiltic
+
+PHI = (1 + math.sqrt(5)) / 2
+PSI = (1 - math.sqrt(5)) / 2
+
+
+def fib(n):
+    """
+    Exact F(n) by fast doubling, O(log n) big-integer multiplications:
+        F(2k) = F(k) * (2F(k+1) - F(k)),    F(2k+1) = F(k)^2 + F(k+1)^2
+    """
+    if n < 0:
+        raise ValueError("n must be non-negative, got %d" % n)
+    a, b = 0, 1  # F(k), F(k+1), with k built from the bits of n
+    for bit in bin(n)[2:]:
+        c = a * (2*b - a)
+        d = a*a + b*b
+        a, b = (d, c + d) if bit == "1" else (c, d)
+    return a
+
+
+@lru_cache(maxsize=4096)
+def fib_pair(n):
+    # (F(n), F(n+1)) by the same doubling, recursively, so repeated queries share
+    # the cached pairs of n // 2, n // 4, ...
+    if n == 0:
+        return 0, 1
+    a, b = fib_pair(n // 2)
+    c = a * (2*b - a)
+    d = a*a + b*b
+    return (d, c + d) if n % 2 else (c, d)
+
+
+def fib_cached(n):
+    """F(n) through an LRU cache of doubling steps, for many repeated or nearby n."""
+    if n < 0:
+        raise ValueError("n must be non-negative, got %d" % n)
+    return fib_pair(n)[0]
+
+
+def fib_array(n):
+    """
+    F(n) for an array of n as float64 from Binet's formula, in one vectorized pass.
+    Exact (after rounding) up to n = 70, then good to float precision; inf past 1476.
+    """
+    n = np.asarray(n, dtype=np.float64)
+    with np.errstate(over="ignore"):
+        return np.rint((PHI**n - PSI**n) / math.sqrt(5))
+
+
+# linear recurrences
+def first_order(p, q, initial_val):
+    # s, p*s+q, ... as a stream
+    return it.accumulate(it.repeat(initial_val), lambda s,_: p*s+q)
+
+
+def second_order(p, q, r, initial_values):
+    # s0, s1, p*s1+q*s0+r, ... as a stream
+    intermediate = it.accumulate(it.repeat(initial_values), lambda s,_: (s[1], p*s[1] + q*s[0] + r))
+    return map(lambda x: x[0], intermediate)
+
+
+def _as_int(c):
+    # NumPy integers become Python ints, so exact products cannot overflow
+    return int(c) if isinstance(c, numbers.Integral) else c
+
+
+def companion(p, q, r=None):
+    """
+    Matrix advancing the state by one term: (s_n, 1) for the first order recurrence
+    s_(n+1) = p s_n + q, and (s_(n+1), s_n, 1) for the second order one
+    s_(n+2) = p s_(n+1) + q s_n + r. Integer coefficients (Python or NumPy) give an
+    object array of Python ints, so powers stay exact.
+    """
+    if r is None:
+        M = [[p, q], [0, 1]]
+        coeffs = (p, q)
+    else:
+        M = [[p, q, r], [1, 0, 0], [0, 0, 1]]
+        coeffs = (p, q, r)
+    exact = all(isinstance(c, numbers.Integral) for c in coeffs)
+    if exact:
+        M = [[_as_int(c) for c in row] for row in M]
+    return np.array(M, dtype=object if exact else np.float64)
+
+
+def _matrix_power(M, k):
+    # repeated squaring, which also works for exact object arrays
+    result = np.identity(len(M), dtype=M.dtype)
+    if M.dtype == object:
+        result = result.astype(int).astype(object)
+    while k:
+        if k & 1:
+            result = result @ M
+        M = M @ M
+        k >>= 1
+    return result
+
+
+def first_order_term(p, q, initial_val, k):
+    """The k-th term (from 0) of first_order(p, q, initial_val), in O(log k) steps."""
+    M = _matrix_power(companion(p, q), k)
+    return M[0, 0]*_as_int(initial_val) + M[0, 1]
+
+
+def second_order_term(p, q, r, initial_values, k):
+    """The k-th term (from 0) of second_order(p, q, r, initial_values), in O(log k) steps."""
+    s0, s1 = map(_as_int, initial_values)
+    if k == 0:
+        return s0
+    M = _matrix_power(companion(p, q, r), k - 1)
+    return M[0, 0]*s1 + M[0, 1]*s0 + M[0, 2]
+
+
+def first_order_terms(p, q, initial_val, k):
+    """The first k terms of first_order as a float array, by one IIR filter pass."""
+    if k <= 1:
+        return np.full(k, initial_val, dtype=np.float64)
+    zi = lfiltic([1.], [1., -p], y=[initial_val])
+    rest, _ = lfilter([1.], [1., -p], np.full(k - 1, q, dtype=np.float64), zi=zi)
+    return np.concatenate([[initial_val], rest])
+
+
+def second_order_terms(p, q, r, initial_values, k):
+    """The first k terms of second_order as a float array, by one IIR filter pass."""
+    s0, s1 = initial_values
+    if k <= 2:
+        return np.array([s0, s1][:k], dtype=np.float64)
+    zi = lfiltic([1.], [1., -p, -q], y=[s1, s0])
+    rest, _ = lfilter([1.], [1., -p, -q], np.full(k - 2, r, dtype=np.float64), zi=zi)
+    return np.concatenate([[s0, s1], rest])
@@ -6,7 +6,10 @@ Created on Wed May 29 16:34:24 2019
 @author: gparkes
 """
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import itertools as it
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 def task_1():
@@ -16,7 +19,9 @@ def task_1():
 
 
 # task 2
-def fisher_wright(P, s, mu, nu, Tmax):
+def fisher_wright(P, s, mu, nu, Tmax, rng=None):
+    # rng is a np.random.Generator; by default the global np.random state is used
+    rng = np.random if rng is None else rng
     t = 0
     n = np.zeros((Tmax+1), dtype=np.int64)
     while n[t]<P and t<Tmax:
@@ -26,7 +31,7 @@ def fisher_wright(P, s, mu, nu, Tmax):
         p_sm = (1-nu)*p_s + mu*(1.-p_s)
         # sample
         t += 1
-        n[t] = np.random.binomial(P, p_sm)
+        n[t] = rng.binomial(P, p_sm)
     return n[:t+1]
 
 
@@ -69,14 +74,130 @@ def fisher_wright_modified(P, s, mu, nu, Tmax, Nr):
 
 
 def task_4():
-    nt2 = fisher_wright_modified(200, 0.1, 0.001, 0.001, int(10**3), int(10**4))
-    ntm = nt2.mean(axis=1)
-    ntsd = nt2.std(axis=1)
-    t = np.arange(len(nt2))
+    ens = fisher_wright_ensemble(200, 0.1, 0.001, 0.001, int(10**3), int(10**4))
+    t, ntm, ntsd = ens["t"], ens["mean"], ens["std"]
 
     plt.plot(t, ntm, 'k-')
     plt.fill_between(t, ntm - 2*ntsd, ntm + 2*ntsd, color='r', alpha=.4)
+    plt.plot(t, ens["quantiles"], 'k:')
     plt.xlabel(r"$t$")
     plt.ylabel(r"$n \,$ mutants")
 
     plt.show()
+
+
+# task 5: large ensembles
+def fisher_wright_ensemble(P, s, mu, nu, Tmax, Nr, n0=0, quantiles=(.025, .5, .975), rng=None):
+    """
+    Runs Nr replicates of fisher_wright together, keeping only the current generation.
+    A replicate is absorbed, and dropped from the active set, when it reaches a state it
+    can never leave: fixation (n = P) if nu = 0, loss (n = 0) if mu = 0. With nu > 0 a
+    fixed replicate keeps evolving, as in fisher_wright_modified. Absorbed replicates
+    still count towards the statistics at their final value.
+
+    Per generation t the mean, std and `quantiles` over all replicates are streamed
+    from a histogram of n, costing O(active + P) per step instead of re-scanning the
+    history. Returns a dict of these series with the fixation time of each replicate
+    (its first passage to n = P, or -1 if it never got there), the fraction that fixed
+    by Tmax and the fraction absorbed by loss.
+    """
+    rng = np.random.default_rng(rng)
+    k = np.arange(P + 1)
+    q = np.asarray(quantiles)
+    n = np.full(Nr, n0, dtype=np.int64)
+    idx = np.arange(Nr)
+    fixation_time = np.full(Nr, -1, dtype=np.int64)
+    n_fixed = n_lost = 0
+    mean, std, quant = [], [], []
+
+    t = 0
+    while True:
+        # record first passages to P, then drop the absorbed replicates from the active set
+        at_P = n == P
+        first = idx[at_P][fixation_time[idx[at_P]] < 0]
+        fixation_time[first] = t
+        fixed = at_P if nu == 0 else np.zeros_like(at_P)
+        lost = (n == 0) if mu == 0 else np.zeros_like(at_P)
+        n_fixed += np.count_nonzero(fixed)
+        n_lost += np.count_nonzero(lost)
+        keep = ~(fixed | lost)
+        n, idx = n[keep], idx[keep]
+
+        hist = np.bincount(n, minlength=P + 1)
+        hist[P] += n_fixed
+        hist[0] += n_lost
+        m = hist @ k / Nr
+        mean.append(m)
+        std.append(np.sqrt(max(hist @ k**2 / Nr - m**2, 0.)))
+        quant.append(np.searchsorted(np.cumsum(hist), q * Nr))
+
+        if len(n) == 0 or t == Tmax:
+            break
+        # select
+        p_s = (1+s)*n / (P+s*n)
+        # mutate
+        p_sm = (1-nu)*p_s + mu*(1.-p_s)
+        # sample
+        t += 1
+        n = rng.binomial(P, p_sm)
+
+    return {"t": np.arange(t + 1),
+            "mean": np.array(mean),
+            "std": np.array(std),
+            "quantiles": np.array(quant),
+            "fixation_time": fixation_time,
+            "p_fixation": np.count_nonzero(fixation_time >= 0) / Nr,
+            "p_loss": n_lost / Nr}
+
+
+# task 6: parameter sweeps
+def _fisher_wright_point(params, seq, Tmax, Nr):
+    P, s, mu, nu = params
+    ens = fisher_wright_ensemble(P, s, mu, nu, Tmax, Nr, rng=np.random.default_rng(seq))
+    fixed = ens["fixation_time"][ens["fixation_time"] >= 0]
+    return {"P": P, "s": s, "mu": mu, "nu": nu,
+            "p_fixation": ens["p_fixation"],
+            "p_loss": ens["p_loss"],
+            "mean_fixation_time": fixed.mean() if len(fixed) else np.nan,
+            "generations": ens["t"][-1],
+            "final_mean": ens["mean"][-1],
+            "final_std": ens["std"][-1]}
+
+
+def fisher_wright_grid(Ps, ss, mus, nus, Tmax, Nr, seed=0, max_workers=None,
+                       executor="thread", path=None):
+    """
+    Runs fisher_wright_ensemble over every (P, s, mu, nu) combination on a thread pool
+    (the binomial draws release the GIL) or, with executor="process", a process pool.
+    Every point draws from its own Generator spawned from SeedSequence(seed), so a
+    sweep is exactly re-runnable whatever the scheduling. The summary table is
+    returned and, if `path` is given, written as parquet.
+    """
+    grid = list(it.product(Ps, ss, mus, nus))
+    seqs = np.random.SeedSequence(seed).spawn(len(grid))
+    if executor == "thread":
+        Pool = ThreadPoolExecutor
+    elif executor == "process":
+        Pool = ProcessPoolExecutor
+    else:
+        raise ValueError("executor must be 'thread' or 'process', got %r" % executor)
+
+    with Pool(max_workers) as pool:
+        rows = list(pool.map(_fisher_wright_point, grid, seqs,
+                             it.repeat(Tmax), it.repeat(Nr)))
+    table = pd.DataFrame(rows)
+    if path is not None:
+        table.to_parquet(path, index=False)
+    return table
+
+
+def task_6():
+    table = fisher_wright_grid([200], np.linspace(0, .2, 11), [.001, .01], [.001],
+                               int(10**3), int(10**4), path="fisher_wright_grid.parquet")
+    fig, axes = plt.subplots(figsize=(8,6))
+    for mu, group in table.groupby("mu"):
+        axes.plot(group["s"], group["mean_fixation_time"], 'x-', label=r"$\mu=%g$" % mu)
+    axes.set_xlabel(r"$s$")
+    axes.set_ylabel("mean fixation time")
+    axes.legend()
+    plt.show()
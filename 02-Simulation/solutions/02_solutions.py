@@ -5,8 +5,16 @@ Created on Wed May 29 16:40:20 2019
 
 @author: gparkes
 """
+import os
+import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy import integrate, ndimage
+import pandas as pd
+import dask
+import dask.array as da
+from scipy import integrate, ndimage, sparse
+from scipy.sparse.csgraph import connected_components
 import matplotlib.pyplot as plt
 
 def task_1():
@@ -61,12 +69,59 @@ def task_3():
 
 def task_4():
     sigs = np.logspace(-1,0.7,9)
+    # one incremental stack instead of nine blurs of the full image
+    sigs, stack = scale_space(A.mean(axis=2), sigs, normalize=False)
     fig,ax = plt.subplots(ncols=3, nrows=3, figsize=(15,10))
     for i,s in enumerate(sigs):
-        ax[i%3,int(i/3)].imshow(ndimage.laplace(ndimage.gaussian_filter(A, s)))
+        ax[i%3,int(i/3)].imshow(stack[i])
         ax[i%3,int(i/3)].set_title(r"$\sigma$=%.3f" % s)
 
 
+def scale_space(A, sigmas, kind="log", normalize=True, truncate=4., min_step=1.):
+    """
+    Laplacian-of-Gaussian ("log") or difference-of-Gaussian ("dog") stack of a 2-d
+    image, in one preallocated float32 cube. The blurs are built incrementally: since
+    variances add, going from sigma_(k-1) to sigma_k only needs a blur of
+    sqrt(sigma_k^2 - sigma_(k-1)^2), applied as two separable 1-d passes. Sampled
+    kernels narrower than `min_step` pixels do not compose like Gaussians, so such
+    steps blur the original image with sigma_k directly (a short kernel anyway).
+
+    With `normalize` the LoG is scaled by sigma^2 so responses compare across scales.
+    Returns the sorted sigmas and the stack (one layer per sigma, or one fewer for
+    "dog", layer k being G(sigma_(k+1)) - G(sigma_k)).
+    """
+    if kind not in ("log", "dog"):
+        raise ValueError("kind must be 'log' or 'dog', got %r" % kind)
+    sigmas = np.sort(np.asarray(sigmas, dtype=float))
+    A = np.asarray(A, dtype=np.float32)
+    G = A.copy()
+    tmp = np.empty_like(G)
+    cube = np.empty((len(sigmas),) + G.shape, dtype=np.float32)
+
+    prev = 0.
+    for k, s in enumerate(sigmas):
+        d = np.sqrt(s**2 - prev**2)
+        source = G
+        if d < min_step:
+            source, d = A, s
+        if d > 0:
+            ndimage.gaussian_filter1d(source, d, axis=0, output=tmp, truncate=truncate)
+            ndimage.gaussian_filter1d(tmp, d, axis=1, output=G, truncate=truncate)
+        prev = s
+        if kind == "log":
+            ndimage.laplace(G, output=cube[k])
+            if normalize:
+                cube[k] *= s**2
+        else:
+            cube[k] = G
+
+    if kind == "dog":
+        for k in range(len(sigmas) - 1, 0, -1):
+            cube[k] -= cube[k-1]
+        return sigmas, cube[1:]
+    return sigmas, cube
+
+
 def task_5():
     fig,ax = plt.subplots(ncols=3, figsize=(16,4))
     a_set, _ = ndimage.label(A > A.mean())
@@ -78,3 +133,207 @@ def task_5():
     c_set, _ = ndimage.label(c_mat > c_mat.mean())
     ax[2].imshow(c_set)
     plt.show()
+
+
+# task 6: many images
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+
+def resolve_filter(spec):
+    """
+    A filter is a callable on an array, the name of an ndimage filter ("laplace"), or
+    a (name, kwargs) pair such as ("gaussian_filter", {"sigma": 2.}).
+    """
+    if callable(spec):
+        return spec
+    name, kwargs = (spec, {}) if isinstance(spec, str) else spec
+    f = getattr(ndimage, name)
+    return lambda A: f(A, **kwargs)
+
+
+def list_images(source):
+    # a folder (every image in it) or a glob pattern
+    if os.path.isdir(source):
+        source = os.path.join(source, "*")
+    return sorted(p for p in glob.glob(source) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _process_image(path, filters, grey, label, out_path):
+    # decoded here, inside the worker, so only images in flight are in memory
+    A = plt.imread(path)
+    if grey and A.ndim == 3:
+        A = A[..., :3].mean(axis=2)
+    A = A.astype(np.float32)
+    for f in filters:
+        A = f(A)
+    row = {"path": path, "height": A.shape[0], "width": A.shape[1],
+           "mean": float(A.mean()), "std": float(A.std())}
+    if label:
+        labels, n = ndimage.label(A > A.mean())
+        sizes = np.bincount(labels.ravel())[1:]
+        row.update({"n_labels": n,
+                    "mean_label_size": sizes.mean() if n else 0.,
+                    "max_label_size": sizes.max() if n else 0})
+    if out_path is not None:
+        np.save(out_path, A)
+        row["output"] = out_path
+    return row
+
+
+def image_pipeline(source, filters, out_dir=None, label=False, grey=True, max_workers=None):
+    """
+    Applies the chain `filters` to every image in `source` (a folder or glob) on a
+    thread pool; the ndimage filters release the GIL, so threads use every core. At
+    most two images per worker are decoded at any time. Filtered images are saved in
+    `out_dir` if given, as <file name with extension>.npy, and a ValueError is raised
+    up front if two inputs would share an output. With `label=True` the components
+    above the mean are counted. Returns one row of statistics per image.
+    """
+    filters = [resolve_filter(f) for f in filters]
+    paths = list_images(source)
+    outputs = dict.fromkeys(paths)
+    if out_dir is not None:
+        for path in paths:
+            outputs[path] = os.path.join(out_dir, os.path.basename(path) + ".npy")
+        seen = {}
+        for path, out in outputs.items():
+            if out in seen:
+                raise ValueError("%s and %s would both be saved as %s"
+                                 % (seen[out], path, out))
+            seen[out] = path
+        os.makedirs(out_dir, exist_ok=True)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    rows = []
+    with ThreadPoolExecutor(max_workers) as pool:
+        window = 2 * max_workers
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(_process_image, path, filters, grey, label,
+                                       outputs[path]))
+            if len(pending) >= window:
+                rows.append(pending.popleft().result())
+        while pending:
+            rows.append(pending.popleft().result())
+    return pd.DataFrame(rows)
+
+
+def task_6():
+    stats = image_pipeline(".", [("gaussian_filter", {"sigma": 2.2}), "laplace"], label=True)
+    print(stats)
+
+
+# task 7: images larger than memory
+def filter_radius(spec):
+    """
+    How far the footprint of a filter spec (see resolve_filter) reaches, i.e. the halo
+    a tile needs. Callables must be given as (callable, radius).
+    """
+    if isinstance(spec, tuple) and callable(spec[0]):
+        return spec[1]
+    name, kwargs = (spec, {}) if isinstance(spec, str) else spec
+    if name == "gaussian_filter":
+        return int(kwargs.get("truncate", 4.) * np.max(kwargs["sigma"]) + .5) + \
+            kwargs.get("order", 0)
+    if name in ("laplace", "sobel", "prewitt"):
+        return 1
+    if name in ("uniform_filter", "median_filter", "maximum_filter", "minimum_filter"):
+        return int(np.max(kwargs["size"])) // 2
+    raise ValueError("no known footprint for %r, pass (callable, radius)" % (spec,))
+
+
+def _apply_chain(block, filters):
+    block = block.astype(np.float32)
+    for f in filters:
+        block = f(block)
+    return block
+
+
+def tiled_filter(A, filters, chunks=2048):
+    """
+    Lazily applies a filter chain to a 2-d image tile by tile with map_overlap. Each
+    tile gets a halo equal to the summed footprint of the chain, so the result matches
+    filtering the whole image. `A` can be a memory-mapped array
+    (np.load(path, mmap_mode="r")), in which case only the tiles in flight are read.
+    """
+    depth = sum(filter_radius(f) for f in filters)
+    chain = [resolve_filter(f[0] if isinstance(f, tuple) and callable(f[0]) else f)
+             for f in filters]
+    x = A if hasattr(A, "map_overlap") else da.from_array(A, chunks=chunks)
+    return x.map_overlap(_apply_chain, depth=depth, boundary="reflect", dtype=np.float32,
+                         filters=chain)
+
+
+def store_memmap(x, path):
+    # writes a dask array into a new .npy file block by block
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=x.dtype, shape=x.shape)
+    da.store(x, out, lock=False)
+    out.flush()
+    return out
+
+
+def tiled_label(mask):
+    """
+    Connected components (4-connectivity, as ndimage.label) of a 2-d Dask boolean
+    array. Tiles are labelled independently; labels touching across tile borders are
+    then merged with a sparse connected-components pass over the border pixels only,
+    and a second pass relabels each tile. Returns the lazy labels, numbered 1..n, and n.
+    """
+    nby, nbx = mask.numblocks
+    # a tile of h*w pixels has at most ceil(h*w/2) components
+    stride = max(mask.chunks[0]) * max(mask.chunks[1]) // 2 + 2
+
+    def label_block(b, block_info=None):
+        labels, _ = ndimage.label(b)
+        i, j = block_info[0]["chunk-location"]
+        return np.where(labels > 0, labels + (i*nbx + j)*stride, 0)
+
+    labels = mask.map_blocks(label_block, dtype=np.int64)
+    counts = labels.map_blocks(lambda b: np.array([[b.max() % stride]]), dtype=np.int64,
+                               chunks=(1, 1))
+    rows = np.cumsum(mask.chunks[0])[:-1]
+    cols = np.cumsum(mask.chunks[1])[:-1]
+    faces = [(labels[r-1, :], labels[r, :]) for r in rows] + \
+        [(labels[:, c-1], labels[:, c]) for c in cols]
+    # the tiles are labelled once for the counts and all the faces together
+    counts, faces = dask.compute(counts, faces)
+
+    counts = counts.ravel()
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    total = int(counts.sum())
+
+    def compact(v):
+        return offsets[v // stride] + v % stride - 1
+
+    a = np.concatenate([f[0] for f in faces] + [np.zeros(0, dtype=np.int64)])
+    b = np.concatenate([f[1] for f in faces] + [np.zeros(0, dtype=np.int64)])
+    both = (a > 0) & (b > 0)
+    edges = sparse.coo_matrix((np.ones(both.sum()), (compact(a[both]), compact(b[both]))),
+                              shape=(total, total))
+    n, component = connected_components(edges, directed=False)
+
+    def relabel_block(b, block_info=None):
+        labels, _ = ndimage.label(b)
+        i, j = block_info[0]["chunk-location"]
+        out = np.zeros(labels.shape, dtype=np.int64)
+        inside = labels > 0
+        out[inside] = component[offsets[i*nbx + j] + labels[inside] - 1] + 1
+        return out
+
+    return mask.map_blocks(relabel_block, dtype=np.int64), n
+
+
+def task_7():
+    # the grey cat as a memory-mapped .npy stands in for an image larger than RAM
+    np.save("bigcat.npy", A.mean(axis=2).astype(np.float32))
+    img = np.load("bigcat.npy", mmap_mode="r")
+    b = tiled_filter(img, [("gaussian_filter", {"sigma": 2.2}), "laplace"], chunks=128)
+    b_mat = store_memmap(b, "bigcat_log.npy")
+    b_set, n = tiled_label(da.from_array(b_mat, chunks=128) > b_mat.mean())
+    b_set = store_memmap(b_set, "bigcat_labels.npy")
+
+    fig,ax = plt.subplots(ncols=2, figsize=(16,4))
+    ax[0].imshow(b_mat)
+    ax[1].imshow(b_set)
+    ax[1].set_title("%d components" % n)
+    plt.show()
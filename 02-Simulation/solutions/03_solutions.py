@@ -6,24 +6,17 @@ Created on Wed May 29 16:48:37 2019
 @author: gparkes
 """
 import numpy as np
+import dask
 import dask.array as da
 import matplotlib.pyplot as plt
+from stencil import periodic_sum, MOORE
 
 # task 1
 def life_step_dask(x):
+    c_grid = periodic_sum(x, MOORE)
 
-    def access_roll(x):
-        #da.roll extracts an array where all values are shifted left, right, up or down
-        l_roll = da.roll(x,1,axis=0)
-        r_roll = da.roll(x,-1,axis=0)
-        return l_roll + r_roll + da.roll(x,1,axis=1) + da.roll(x,-1,axis=1) + \
-            da.roll(l_roll, 1, axis=1) + da.roll(l_roll, -1, axis=1) + \
-            da.roll(r_roll, 1, axis=1) + da.roll(r_roll, -1, axis=1)
-
-    c_grid = da.map_overlap(x, access_roll, depth=1, boundary="periodic")
-
-    nx = x - ((x == 1) & ((c_grid < 2) | (c_grid > 3))).astype(np.int)
-    nx = nx + ((x == 0) & (c_grid == 3)).astype(np.int)
+    nx = x - ((x == 1) & ((c_grid < 2) | (c_grid > 3))).astype(x.dtype)
+    nx = nx + ((x == 0) & (c_grid == 3)).astype(x.dtype)
     return nx
 
 N=10
@@ -52,13 +45,10 @@ def task_3():
 
     fig,ax=plt.subplots(ncols=4, nrows=4, figsize=(16,8))
 
-    current = x
+    # observing the grid itself brings back every generation for plotting
+    _, t, frames = life_run_dask(x, steps, observe=lambda g: g, fuse=1)
     for i in range(steps):
-        curr_arr = life_step_dask(current).compute()
-        # re-create dask array from numpy.array
-        current = da.from_array(curr_arr, chunks=(chunksize,chunksize))
-        # plot
-        ax[i%4,int(i/4)].imshow(curr_arr)
+        ax[i%4,int(i/4)].imshow(frames[i])
         ax[i%4,int(i/4)].set_title(i)
 
 
@@ -68,20 +58,278 @@ def task_4():
     steps = 200
 
     x = da.random.randint(2, size=(N,N), chunks=(chunksize,chunksize))
-    t = np.arange(steps)
-    s_tot = np.zeros(steps)
 
     fig,ax=plt.subplots()
 
-    current = x
-    for i in range(steps):
-        curr_arr = life_step_dask(current).compute()
-        # compute sum
-        s_tot[i] = curr_arr.mean()
-        # re-create dask array from numpy.array
-        current = da.from_array(curr_arr, chunks=(chunksize,chunksize))
+    # only the alive fraction of every generation comes back to the driver, counted
+    # inside batches of 8 fused generations
+    _, t, s_tot = life_run_dask(x, steps, fuse=8, alive=True)
 
     ax.plot(t, s_tot, 'kx-')
     ax.set_xlabel(r"steps")
     ax.set_ylabel("proportion of units alive")
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+# task 5: many generations per graph
+def _life_steps(block, steps):
+    # plain generations on one overlapped block; each step the outermost ring of cells
+    # goes stale, so a halo of depth `steps` keeps the interior exact
+    for _ in range(steps):
+        c_grid = periodic_sum(block, MOORE)
+        block = ((c_grid == 3) | ((block == 1) & (c_grid == 2))).astype(block.dtype)
+    return block
+
+
+def _counted_block(block, steps, depth, step_f, bits):
+    # the fused generations of one overlapped block, counting the live cells of its
+    # interior (exact for up to `depth` generations) after every one
+    dy, dx = depth
+    counts = np.zeros(steps, dtype=np.int64)
+    for j in range(steps):
+        block = step_f(block, steps=1)
+        inner = block[dy:block.shape[0]-dy, dx:block.shape[1]-dx]
+        counts[j] = _POPCOUNT8[inner.view(np.uint8)].sum() if bits else np.count_nonzero(inner)
+    return inner, counts
+
+
+def _life_steps_counted(x, steps, depth, step_f, bits):
+    # like map_overlap, but each block also hands back its per-generation counts
+    ov = da.overlap.overlap(x, depth={0: depth[0], 1: depth[1]}, boundary="periodic")
+    results = [[dask.delayed(_counted_block, nout=2)(b, steps, depth, step_f, bits)
+                for b in row] for row in ov.to_delayed()]
+    grid = da.block([[da.from_delayed(r[0], shape=(x.chunks[0][i], x.chunks[1][j]),
+                                      dtype=x.dtype)
+                      for j, r in enumerate(row)] for i, row in enumerate(results)])
+    counts = dask.delayed(sum)([r[1] for row in results for r in row])
+    return grid, counts
+
+
+def life_run_dask(x, steps, observe=None, fuse=8, bits=False, alive=False):
+    """
+    Advances `x` by `steps` generations, fusing `fuse` generations into each
+    map_overlap (halo depth `fuse`, capped by the smallest chunk) so blocks only
+    exchange borders once per `fuse` steps. After each fused batch the grid is
+    persisted, which on a distributed client keeps it on the workers, and only
+    `observe(x)` (e.g. the alive fraction) is computed back to the driver.
+
+    With `alive=True` each block also counts its live cells after every generation
+    inside the fused batch, and the alive fraction of every generation is returned
+    in place of observe's values, so per-generation curves keep the fusion.
+
+    With `bits=True`, `x` is a packed grid (see pack_cells) and a halo of one word
+    covers up to 64 fused generations along the rows.
+
+    Returns the final (lazy) grid, the generations at which observations were taken
+    and the observations.
+    """
+    if bits:
+        fuse = max(1, min(fuse, 64, min(x.chunks[0])))
+        step_f = _life_steps_bits
+    else:
+        fuse = max(1, min(fuse, min(min(c) for c in x.chunks)))
+        step_f = _life_steps
+    t, values = [], []
+    done = 0
+    while done < steps:
+        k = min(fuse, steps - done)
+        if alive:
+            x, counts = _life_steps_counted(x, k, (k, 1) if bits else (k, k), step_f, bits)
+            x, counts = dask.persist(x, counts)
+            t.extend(range(done + 1, done + k + 1))
+            values.extend(counts.compute() / (x.size * (64 if bits else 1)))
+            done += k
+            continue
+        depth = {0: k, 1: 1} if bits else k
+        x = x.map_overlap(step_f, depth=depth, boundary="periodic", dtype=x.dtype, steps=k)
+        x = x.persist()
+        done += k
+        if observe is not None:
+            t.append(done)
+            values.append(observe(x).compute())
+    return x, np.array(t), np.array(values)
+
+
+# task 6: one bit per cell
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _pack_block(x):
+    return np.packbits(x.astype(bool), axis=-1, bitorder="little").view("<u8")
+
+
+def _unpack_block(p):
+    return np.unpackbits(p.view(np.uint8), axis=-1, bitorder="little")
+
+
+def pack_cells(x):
+    """
+    Packs a 0/1 grid into uint64 words along the rows, bit k of word w holding column
+    64*w + k. The row length (and, for Dask, every row chunk) must be a multiple of 64.
+    """
+    if hasattr(x, "map_blocks"):
+        if any(c % 64 for c in x.chunks[1]):
+            raise ValueError("row chunks must be multiples of 64, got %s" % (x.chunks[1],))
+        return x.map_blocks(_pack_block, dtype="<u8",
+                            chunks=(x.chunks[0], tuple(c // 64 for c in x.chunks[1])))
+    if x.shape[1] % 64:
+        raise ValueError("rows must be a multiple of 64 cells, got %d" % x.shape[1])
+    return _pack_block(x)
+
+
+def unpack_cells(p):
+    # back to one uint8 per cell
+    if hasattr(p, "map_blocks"):
+        return p.map_blocks(_unpack_block, dtype=np.uint8,
+                            chunks=(p.chunks[0], tuple(c * 64 for c in p.chunks[1])))
+    return _unpack_block(p)
+
+
+def alive_fraction_bits(p):
+    # popcount of every byte through a lookup table
+    count = lambda b: _POPCOUNT8[b.view(np.uint8)].sum(dtype=np.int64, keepdims=True)
+    if hasattr(p, "map_blocks"):
+        alive = p.map_blocks(count, dtype=np.int64, chunks=(1, 1)).sum()
+    else:
+        alive = count(p).item()
+    return alive / (p.size * 64)
+
+
+def _life_steps_bits(p, steps=1):
+    one, top = np.uint64(1), np.uint64(63)
+    for _ in range(steps):
+        # the eight neighbours as bit planes: rows above and below by rolling whole
+        # rows, columns either side by shifting bits across word boundaries
+        planes = []
+        for row in (np.roll(p, 1, axis=0), p, np.roll(p, -1, axis=0)):
+            planes.append((row << one) | (np.roll(row, 1, axis=1) >> top))
+            planes.append((row >> one) | (np.roll(row, -1, axis=1) << top))
+            if row is not p:
+                planes.append(row)
+        # bit-sliced counter b2 b1 b0, with b2 sticking once the count reaches 4
+        b0 = np.zeros_like(p)
+        b1 = np.zeros_like(p)
+        b2 = np.zeros_like(p)
+        for n in planes:
+            c0 = b0 & n
+            b0 ^= n
+            b2 |= b1 & c0
+            b1 ^= c0
+        # alive next if the count is 3, or 2 and already alive
+        p = b1 & ~b2 & (b0 | p)
+    return p
+
+
+def life_step_bits(p):
+    """
+    One generation on a packed grid, as a drop-in for life_step_dask on the output of
+    pack_cells. Neighbours are counted with bitwise adders, 64 cells per operation.
+    """
+    if hasattr(p, "map_overlap"):
+        return p.map_overlap(_life_steps_bits, depth={0: 1, 1: 1}, boundary="periodic",
+                             dtype=p.dtype)
+    return _life_steps_bits(p)
+
+
+# task 7: only the live regions
+class SparseLife(object):
+    """
+    A periodic (N, M) board kept as a dict of T x T tiles, storing only the tiles that
+    contain live cells. N and M must be multiples of T.
+    """
+
+    def __init__(self, shape, tile=64, tiles=None):
+        if shape[0] % tile or shape[1] % tile:
+            raise ValueError("board %s is not a whole number of %d-tiles" % (shape, tile))
+        self.shape = tuple(shape)
+        self.tile = tile
+        self.ntiles = (shape[0] // tile, shape[1] // tile)
+        self.tiles = {} if tiles is None else tiles
+
+    @classmethod
+    def from_dense(cls, x, tile=64):
+        grid = cls(x.shape, tile)
+        for i in range(grid.ntiles[0]):
+            for j in range(grid.ntiles[1]):
+                block = x[i*tile:(i+1)*tile, j*tile:(j+1)*tile]
+                if block.any():
+                    grid.tiles[(i, j)] = block.astype(np.uint8)
+        return grid
+
+    def to_dense(self):
+        x = np.zeros(self.shape, dtype=np.uint8)
+        T = self.tile
+        for (i, j), block in self.tiles.items():
+            x[i*T:(i+1)*T, j*T:(j+1)*T] = block
+        return x
+
+    def population(self):
+        return sum(int(block.sum()) for block in self.tiles.values())
+
+    def padded(self, key):
+        # the tile with a one-cell border taken from its (wrapped) neighbours
+        T = self.tile
+        out = np.zeros((T+2, T+2), dtype=np.uint8)
+        rows = {-1: (slice(0, 1), slice(T-1, T)), 0: (slice(1, T+1), slice(0, T)),
+                1: (slice(T+1, T+2), slice(0, 1))}
+        for di, (dst_i, src_i) in rows.items():
+            for dj, (dst_j, src_j) in rows.items():
+                nb = self.tiles.get(((key[0]+di) % self.ntiles[0], (key[1]+dj) % self.ntiles[1]))
+                if nb is not None:
+                    out[dst_i, dst_j] = nb[src_i, src_j]
+        return out
+
+
+def life_step_sparse(grid):
+    """
+    One generation of a SparseLife board. Only live tiles and their neighbours (where
+    births can happen) are updated, so the cost follows activity rather than area.
+    """
+    nty, ntx = grid.ntiles
+    active = {((i+di) % nty, (j+dj) % ntx) for i, j in grid.tiles
+              for di in (-1, 0, 1) for dj in (-1, 0, 1)}
+    tiles = {}
+    for key in active:
+        block = grid.padded(key)
+        # the wrapped border of the padded tile is trimmed away
+        c_grid = periodic_sum(block, MOORE)[1:-1, 1:-1]
+        block = block[1:-1, 1:-1]
+        nx = ((c_grid == 3) | ((block == 1) & (c_grid == 2))).astype(np.uint8)
+        if nx.any():
+            tiles[key] = nx
+    return SparseLife(grid.shape, grid.tile, tiles)
+
+
+def life_run_sparse(grid, steps, observe=None):
+    # same contract as life_run_dask, observing every generation
+    t, values = [], []
+    for i in range(steps):
+        grid = life_step_sparse(grid)
+        if observe is not None:
+            t.append(i + 1)
+            values.append(observe(grid))
+    return grid, np.array(t), np.array(values)
+
+
+def task_7():
+    # a glider gun on a 2^16 x 2^16 board: far too big for a dense grid every step
+    N = 2**16
+    gun = ["........................O...........",
+           "......................O.O...........",
+           "............OO......OO............OO",
+           "...........O...O....OO............OO",
+           "OO........O.....O...OO..............",
+           "OO........O...O.OO....O.O...........",
+           "..........O.....O.......O...........",
+           "...........O...O....................",
+           "............OO......................"]
+    grid = SparseLife((N, N), tile=64)
+    block = np.zeros((64, 64), dtype=np.uint8)
+    block[10:19, 10:46] = [[c == "O" for c in row] for row in gun]
+    grid.tiles[(0, 0)] = block
+
+    grid, t, pop = life_run_sparse(grid, 1000, observe=lambda g: g.population())
+    plt.plot(t, pop, 'k-')
+    plt.xlabel(r"steps")
+    plt.ylabel("live cells")
+    plt.show()
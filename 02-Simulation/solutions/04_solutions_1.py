@@ -5,14 +5,18 @@ Created on Wed May 29 16:53:19 2019
 
 @author: gparkes
 """
+from functools import reduce
 import numpy as np
+import dask
+from scipy.special import gamma
+from scipy.stats import qmc
 import matplotlib.pyplot as plt
 
 # task 1
-def monte_carlo_integrate(f, dx, dy, N):
+def _hit_miss(f, dx, dy, N, rng):
     area = (dx[1] - dx[0])*(dy[1] - dy[0])
     # generate random numbers in 2-d
-    pairs = np.random.rand(N,2)
+    pairs = rng.random((N,2))
     # move pairs into domain [x,y]
     pairs[:,0] *= dx[1] - dx[0]
     pairs[:,0] += dx[0]
@@ -23,7 +27,162 @@ def monte_carlo_integrate(f, dx, dy, N):
     # choose k where random numbers y fall below the integrand
     k = pairs[:,1] < integrand
 
-    return (area * np.sum(k)) / N
+    p = np.sum(k) / N
+    return area * p, area * np.sqrt(p * (1 - p) / N), integrand
+
+
+def _stratified(f, dx, N, rng):
+    # N/2 equal strata with two points each, so each stratum gives a variance estimate
+    H = max(N // 2, 1)
+    L = dx[1] - dx[0]
+    x = dx[0] + L * (np.arange(H)[:, None] + rng.random((H, 2))) / H
+    fx = f(x)
+    var = np.sum((fx[:, 0] - fx[:, 1])**2 / 2) * (L / H)**2 / 2
+    return L * fx.mean(), np.sqrt(var), fx.ravel()
+
+
+def _antithetic(f, dx, N, rng):
+    # x and its mirror image are negatively correlated for monotone integrands
+    L = dx[1] - dx[0]
+    u = rng.random(max(N // 2, 1))
+    fx = np.stack([f(dx[0] + L*u), f(dx[1] - L*u)])
+    g = L * fx.mean(axis=0)
+    return g.mean(), g.std(ddof=1) / np.sqrt(len(g)), fx.ravel()
+
+
+def _importance(f, dx, N, rng, density):
+    # density is any frozen scipy.stats distribution, or object with rvs and pdf
+    L = dx[1] - dx[0]
+    x = density.rvs(size=N, random_state=rng)
+    inside = (x >= dx[0]) & (x <= dx[1])
+    fx = np.zeros(N)
+    fx[inside] = f(x[inside])
+    w = np.zeros(N)
+    w[inside] = fx[inside] / density.pdf(x[inside])
+    I = w.mean()
+    # a uniform sampler's variance of L*f, estimated from the weighted samples
+    plain = L * np.mean(w * fx) - I**2
+    return I, w.std(ddof=1) / np.sqrt(N), plain
+
+
+def _quasi_random(f, dx, N, rng, method, n_rep=8):
+    # randomised QMC: independent scramblings give the error bar
+    L = dx[1] - dx[0]
+    n = max(N // n_rep, 1)
+    if method == "sobol":
+        # Sobol points are only balanced in powers of two
+        n = 2**int(np.log2(n))
+    I = np.zeros(n_rep)
+    fx = []
+    for r, seed in enumerate(rng.integers(2**32, size=n_rep)):
+        if method == "sobol":
+            sampler = qmc.Sobol(d=1, scramble=True, seed=seed)
+        else:
+            sampler = qmc.Halton(d=1, scramble=True, seed=seed)
+        fx.append(f(dx[0] + L * sampler.random(n)[:, 0]))
+        I[r] = L * fx[-1].mean()
+    return I.mean(), I.std(ddof=1) / np.sqrt(n_rep), np.concatenate(fx)
+
+
+def monte_carlo_integrate(f, dx, dy, N, method="hit-miss", density=None, full_output=False,
+                          rng=None):
+    """
+    Integrates f over dx with N function evaluations. `method` selects the sampling:
+
+    - "hit-miss": points in the box dx * dy under the curve (the original scheme)
+    - "mean": plain mean value of f at uniform points
+    - "stratified": two points in each of N/2 equal strata
+    - "antithetic": pairs of points mirrored about the middle of dx
+    - "importance": points drawn from `density` (a frozen scipy.stats distribution)
+    - "sobol", "halton": scrambled quasi-random points
+
+    dy is only used by "hit-miss". With full_output=True an info dict is also returned,
+    holding the standard error, the number of evaluations actually made (rounded down
+    to whole pairs, strata or quasi-random blocks) and the effective sample size: the
+    number of plain "mean" samples needed for the same standard error.
+    """
+    rng = np.random if rng is None and method == "hit-miss" else np.random.default_rng(rng)
+    L = dx[1] - dx[0]
+    if method == "hit-miss":
+        I, err, fx = _hit_miss(f, dx, dy, N, rng)
+    elif method == "mean":
+        fx = f(dx[0] + L * rng.random(N))
+        I, err = L * fx.mean(), L * fx.std(ddof=1) / np.sqrt(N)
+    elif method == "stratified":
+        I, err, fx = _stratified(f, dx, N, rng)
+    elif method == "antithetic":
+        I, err, fx = _antithetic(f, dx, N, rng)
+    elif method == "importance":
+        if density is None:
+            raise ValueError("importance sampling needs a density")
+        I, err, plain = _importance(f, dx, N, rng, density)
+    elif method in ("sobol", "halton"):
+        I, err, fx = _quasi_random(f, dx, N, rng, method)
+    else:
+        raise ValueError("unknown method %r" % method)
+
+    if not full_output:
+        return I
+    # the helpers return every value of f they drew, which for the paired and
+    # quasi-random modes can be fewer than N
+    n_evals = N
+    if method != "importance":
+        plain = np.var(L * fx)
+        n_evals = len(fx)
+    ess = plain / err**2 if err > 0 else np.inf
+    return I, {"stderr": err, "n_evals": n_evals, "ess": ess}
+
+
+def monte_carlo_stream(f, dx, dy, tol=None, batch=10**5, max_N=10**8, record_at=None,
+                       rng=None):
+    """
+    Hit-or-miss integration in batches of `batch` points drawn into one reused buffer,
+    keeping a running estimate and standard error. Stops once the error reaches `tol`
+    or `max_N` points have been drawn.
+
+    Returns the estimate, its standard error and the convergence trace as a dict of
+    arrays "N", "I" and "err", taken after every batch or, if `record_at` is given,
+    exactly at those sample sizes (each between 1 and max_N).
+    """
+    rng = np.random.default_rng(rng)
+    area = (dx[1] - dx[0])*(dy[1] - dy[0])
+    checkpoints = list(np.unique(record_at)) if record_at is not None else []
+    if checkpoints and (checkpoints[0] < 1 or checkpoints[-1] > max_N):
+        raise ValueError("record_at must lie in [1, max_N=%d], got %d to %d"
+                         % (max_N, checkpoints[0], checkpoints[-1]))
+    buf = np.empty(2*batch)
+    hits = 0
+    N = 0
+    trace = {"N": [], "I": [], "err": []}
+
+    while N < max_N:
+        n = min(batch, max_N - N)
+        if checkpoints:
+            n = min(n, checkpoints[0] - N)
+        u = buf[:2*n]
+        rng.random(out=u)
+        x, y = u[:n], u[n:]
+        # move into domain [x,y] in place
+        x *= dx[1] - dx[0]
+        x += dx[0]
+        y *= dy[1] - dy[0]
+        y += dy[0]
+        hits += np.count_nonzero(y < f(x))
+        N += n
+
+        p = hits / N
+        I = area * p
+        err = area * np.sqrt(p * (1 - p) / N)
+        if record_at is None or (checkpoints and N == checkpoints[0]):
+            trace["N"].append(N)
+            trace["I"].append(I)
+            trace["err"].append(err)
+            if checkpoints:
+                checkpoints.pop(0)
+        # an estimate of p=0 or p=1 also has zero error, so wait for both outcomes
+        if tol is not None and 0 < hits < N and err <= tol:
+            break
+    return I, err, {k: np.array(v) for k, v in trace.items()}
 
 
 # task 2
@@ -32,6 +191,11 @@ def task_2():
         return np.sin(1/(x*(2-x)))**2
     I = monte_carlo_integrate(f, [0, 2], [0, 1], 10**5)
     print(I)
+    # the same budget with each sampling mode
+    for method in ["hit-miss", "mean", "stratified", "antithetic", "sobol", "halton"]:
+        I, info = monte_carlo_integrate(f, [0, 2], [0, 1], 10**5, method, full_output=True)
+        print("%-10s I=%.6f +/- %.1e  n=%d  ESS=%.3g" % (method, I, info["stderr"],
+                                                         info["n_evals"], info["ess"]))
 
 
 # task 3
@@ -39,10 +203,9 @@ def pi(x):
     return np.sqrt(4-x**2)
 
 Nvals = 100*2**np.arange(0,15)
-errs = np.zeros((15,))
-
-for i, N in enumerate(Nvals):
-    errs[i] = abs(monte_carlo_integrate(pi, [0, 2], [0, 2], N ) - np.pi)
+# one streaming pass records the estimate at every N rather than redoing each size
+_, _, trace = monte_carlo_stream(pi, [0, 2], [0, 2], max_N=Nvals[-1], record_at=Nvals)
+errs = np.abs(trace["I"] - np.pi)
 
 
 # task 4
@@ -59,3 +222,66 @@ def task_5():
     m,b = np.polyfit(np.log(Nvals), np.log(errs), 1)
     plt.loglog(Nvals, np.exp(b)*Nvals**m, 'b--')
     plt.show()
+
+
+# task 6: d dimensions, many cores
+def _mc_chunk(f, lo, hi, n, seq):
+    # (count, mean, sum of squared deviations) of f over one chunk of uniform points
+    rng = np.random.default_rng(seq)
+    x = rng.random((n, len(lo)))
+    x *= hi - lo
+    x += lo
+    fx = f(x)
+    m = fx.mean()
+    return n, m, np.sum((fx - m)**2)
+
+
+def _mc_merge(a, b):
+    # combine two partial results (Chan et al.), exact up to rounding
+    na, ma, Ma = a
+    nb, mb, Mb = b
+    n = na + nb
+    d = mb - ma
+    return n, ma + d * nb / n, Ma + Mb + d**2 * na * nb / n
+
+
+def monte_carlo_nd(f, bounds, N, chunk=10**6, scheduler="processes", seed=None):
+    """
+    Mean-value integration of f over the box `bounds` = [(lo, hi), ...] in d dimensions.
+    f takes an (n, d) array of points and returns n values; with the "processes"
+    scheduler it must be picklable (a module-level function, not a lambda).
+
+    The N samples are split into dask.delayed chunks, each with its own stream spawned
+    from SeedSequence(seed), and the partial means and variances are merged in chunk
+    order, so the result does not depend on the number of workers.
+    Returns the estimate and its standard error.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    lo, hi = bounds[:, 0], bounds[:, 1]
+    sizes = [chunk] * (N // chunk) + ([N % chunk] if N % chunk else [])
+    seqs = np.random.SeedSequence(seed).spawn(len(sizes))
+    parts = [dask.delayed(_mc_chunk)(f, lo, hi, n, seq) for n, seq in zip(sizes, seqs)]
+    parts = dask.compute(*parts, scheduler=scheduler)
+
+    n, mean, M2 = reduce(_mc_merge, parts)
+    volume = np.prod(hi - lo)
+    return volume * mean, volume * np.sqrt(M2 / (n - 1) / n)
+
+
+def unit_ball(x):
+    return (np.sum(x**2, axis=1) < 1.).astype(float)
+
+
+def task_6():
+    dims = np.arange(2, 11)
+    vols = np.zeros(len(dims))
+    errs_d = np.zeros(len(dims))
+    for i, d in enumerate(dims):
+        vols[i], errs_d[i] = monte_carlo_nd(unit_ball, [(-1, 1)]*d, 10**7, seed=d)
+
+    plt.errorbar(dims, vols, 2*errs_d, fmt='kx', label="Monte Carlo")
+    plt.plot(dims, np.pi**(dims/2) / gamma(dims/2 + 1), 'b--', label="exact")
+    plt.xlabel(r"$d$")
+    plt.ylabel("volume of the unit ball")
+    plt.legend()
+    plt.show()
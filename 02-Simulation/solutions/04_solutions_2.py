@@ -6,43 +6,21 @@ Created on Wed May 29 16:53:19 2019
 @author: gparkes
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from numba import jit
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
+from stencil import periodic_sum, VON_NEUMANN
 
 # task 1
-@jit(nopython=True)
 def calc_positional_e(spins, J):
     """
-    In this strategy, we use pure Python and beef up our code with JIT or Cython.
+    Sum of the four nearest neighbours of every spin, using the shared periodic stencil
+    rather than a branchy per-cell loop.
     """
-    N = spins.shape[0]
-    E = np.zeros_like(spins)
-    # for loop
-    for i in range(N):
-        for j in range(N):
-            if i == 0:
-                spin_l = spins[N-1,j]
-                spin_r = spins[i+1,j]
-            elif i == N-1:
-                spin_l = spins[i-1,j]
-                spin_r = spins[0,j]
-            else:
-                spin_l = spins[i,j-1]
-                spin_r = spins[i,j+1]
-
-            if j == 0:
-                spin_u = spins[i,N-1]
-                spin_d = spins[i,j+1]
-            elif j == N-1:
-                spin_u = spins[i,j-1]
-                spin_d = spins[i,0]
-            else:
-                spin_u = spins[i,j-1]
-                spin_d = spins[i,j+1]
-
-            E[i,j] = spin_l + spin_r + spin_u + spin_d
-    return E
+    return periodic_sum(spins, VON_NEUMANN)
 
 
 # task 2
@@ -75,7 +53,8 @@ def delta_e(spins, i, j, J):
 
 # task 3
 def total_mag_e(spins, J):
-    return -J*np.sum(calc_positional_e(spins, J))
+    # each bond appears twice in the neighbour sums, hence the half
+    return -.5*J*np.sum(spins*calc_positional_e(spins, J))
 
 
 # task 4
@@ -99,6 +78,65 @@ def metropolis_hastings(N, n_steps, beta):
     return spins, E_series
 
 
+# running totals
+@jit(nopython=True)
+def _seed_numba(seed):
+    np.random.seed(seed)
+
+
+@jit(nopython=True)
+def _metropolis_tracked(spins, n_steps, beta, J, E, M, stride, E_buf, M_buf):
+    N = spins.shape[0]
+    size = E_buf.shape[0]
+    k = 0
+    for s in range(n_steps):
+        i = np.random.randint(N)
+        j = np.random.randint(N)
+        nb = spins[(i-1)%N, j] + spins[(i+1)%N, j] + spins[i, (j-1)%N] + spins[i, (j+1)%N]
+        dE = 2. * J * spins[i, j] * nb
+        if dE < 0. or np.exp(-beta*dE) > np.random.random():
+            # update the totals with the flip rather than recomputing them
+            M -= 2 * spins[i, j]
+            spins[i, j] *= -1
+            E += dE
+        if s % stride == 0:
+            E_buf[k % size] = E
+            M_buf[k % size] = M
+            k += 1
+    return E, M, k
+
+
+def unroll_ring(buf, k):
+    # chronological order of a ring buffer that has been written k times
+    if k <= len(buf):
+        return buf[:k]
+    return np.roll(buf, -(k % len(buf)))
+
+
+def metropolis_tracked(N, n_steps, beta, J=1, stride=1, buffer_size=None, seed=None):
+    """
+    Compiled single-spin Metropolis that keeps the energy and magnetization as running
+    totals. Every `stride` steps they are written into a preallocated ring buffer of
+    `buffer_size` entries (enough for the whole run by default), so memory no longer
+    grows with n_steps.
+
+    Returns (spins, E_series, M_series, E, M) where the series are the last recorded
+    values in order and E, M are the totals after the final step.
+    """
+    if seed is not None:
+        np.random.seed(seed)
+        _seed_numba(seed)
+    spins = np.random.choice([-1, 1], size=(N, N))
+    if buffer_size is None:
+        buffer_size = (n_steps - 1) // stride + 1
+    E_buf = np.empty(buffer_size)
+    M_buf = np.empty(buffer_size, dtype=np.int64)
+
+    E, M, k = _metropolis_tracked(spins, n_steps, float(beta), float(J),
+                                  total_mag_e(spins, J), np.sum(spins), stride, E_buf, M_buf)
+    return spins, unroll_ring(E_buf, k), unroll_ring(M_buf, k), E, M
+
+
 # task 5
 def task_5():
     A = metropolis_hastings(40, int(5*10**5), 0.1)
@@ -127,13 +165,11 @@ def task_6():
     betas = np.linspace(0.1, 0.6, bvals)
     m_ser = np.zeros(bvals)
 
-    def average_magnetization(spins, N):
-        return (1 / N**2) * np.sum(spins)
-
     for b in range(bvals):
         # print("Running beta=%.4f" % betas[b])
-        C, E = metropolis_hastings(20, 500000, betas[b])
-        m_ser[b] = average_magnetization(C[0], 20)
+        # the running magnetization is kept by the engine, no need to re-sum the lattice
+        C, E_ser, M_ser, E, M = metropolis_tracked(20, 500000, betas[b], buffer_size=1)
+        m_ser[b] = M / 20**2
 
     # plot
     fig = plt.figure(figsize=(13,5))
@@ -169,3 +205,266 @@ def task_7():
     ax[1].plot(E3, label=r"python")
     ax[1].plot(E4, label="cython")
     ax[1].legend()
+
+
+# task 8: checkerboard updates
+def checkerboard_masks(N):
+    """
+    Red and black sublattices: every neighbour of a red site is black, so all sites of
+    one colour can be updated at once.
+    """
+    i, j = np.indices((N, N))
+    red = (i + j) % 2 == 0
+    return red, ~red
+
+
+def uniform_buffer(shape, n_block=8, rng=None):
+    """
+    Generator of uniform random arrays of `shape`, drawn `n_block` at a time so the
+    generator is called once per block rather than once per step.
+    """
+    rng = np.random.default_rng(rng)
+    while True:
+        block = rng.random((n_block,) + tuple(shape), dtype=np.float32)
+        for u in block:
+            yield u
+
+
+def acceptance_table(beta, J):
+    # spin*neighbours only takes the values -4,-2,0,2,4, so the Boltzmann factor
+    # is looked up from five entries per beta instead of exponentiating every site
+    sn = np.arange(-4, 5, 2)
+    beta = np.atleast_1d(beta)[:, None]
+    return np.minimum(1., np.exp(-beta * 2. * J * sn))
+
+
+def checkerboard_sweep(spins, table, J, masks, u):
+    """
+    One red then black sweep over a stack of lattices `spins` (R, N, N), in place.
+    `table` holds the acceptance probabilities of each lattice (R, 5) and `u` one
+    uniform per site. Returns the change in energy and magnetization of each lattice.
+    """
+    rows = np.arange(spins.shape[0])[:, None, None]
+    dE = np.zeros(spins.shape[0])
+    dM = np.zeros(spins.shape[0])
+    for mask in masks:
+        sn = spins * periodic_sum(spins, VON_NEUMANN)
+        accept = mask & (u < table[rows, sn // 2 + 2])
+        dE += 2. * J * np.sum(sn, axis=(1, 2), where=accept)
+        dM -= 2. * np.sum(spins, axis=(1, 2), where=accept)
+        np.negative(spins, out=spins, where=accept)
+    return dE, dM
+
+
+def _checkerboard_series(N, n_sweeps, beta, J=1, rng=None, n_block=8):
+    # the shared engine: the final lattice and the energy and magnetization per sweep
+    if N % 2:
+        raise ValueError("checkerboard updates need an even lattice, got N=%d" % N)
+    rng = np.random.default_rng(rng)
+    spins = rng.choice(np.array([-1, 1], dtype=np.int8), size=(1, N, N))
+    table = acceptance_table(beta, J)
+    masks = checkerboard_masks(N)
+    rand = uniform_buffer((N, N), n_block, rng)
+
+    E_series = np.ones(n_sweeps)
+    M_series = np.ones(n_sweeps)
+    E_series[0] = total_mag_e(spins[0], J)
+    M_series[0] = np.sum(spins)
+    for s in range(1, n_sweeps):
+        dE, dM = checkerboard_sweep(spins, table, J, masks, next(rand))
+        E_series[s] = E_series[s-1] + dE[0]
+        M_series[s] = M_series[s-1] + dM[0]
+    return spins[0], E_series, M_series
+
+
+def metropolis_checkerboard(N, n_sweeps, beta, J=1, rng=None, n_block=8):
+    """
+    Vectorized alternative to `metropolis_hastings`. Every sweep proposes a flip at all
+    N**2 sites, so one entry of E_series corresponds to N**2 single-spin steps.
+    """
+    spins, E_series, _ = _checkerboard_series(N, n_sweeps, beta, J, rng, n_block)
+    return spins, E_series
+
+
+def task_8():
+    # 1024x1024 in seconds: 200 sweeps is 2*10^8 single-spin steps
+    C1, E1 = metropolis_checkerboard(1024, 200, .6)
+    C2, E2 = metropolis_checkerboard(1024, 200, .1)
+    fig,ax=plt.subplots(ncols=3, figsize=(16,4))
+
+    ax[0].plot(E1, label=r"$\beta=0.6$")
+    ax[0].plot(E2, label=r"$\beta=0.1$")
+    ax[0].legend()
+    ax[0].set_xlabel("sweeps")
+    ax[0].set_ylabel(r"Energy $E$")
+    ax[1].imshow(C1, cmap="gray")
+    ax[2].imshow(C2, cmap="gray")
+    plt.show()
+
+
+# task 9: parallel temperature sweeps
+def integrated_autocorr(x, c=5.):
+    """
+    Integrated autocorrelation time of a series, using the FFT autocorrelation and
+    the smallest window W with W >= c*tau (Sokal).
+    """
+    x = np.asarray(x, dtype=float) - np.mean(x)
+    n = len(x)
+    if n < 2 or not np.any(x):
+        return 1.
+    f = np.fft.rfft(x, 2*n)
+    acf = np.fft.irfft(f * np.conj(f))[:n]
+    acf /= acf[0]
+    tau = 2. * np.cumsum(acf) - 1.
+    window = np.arange(n) >= c * tau
+    return tau[np.argmax(window)] if window.any() else tau[-1]
+
+
+def ising_point(beta, N, seed, n_sweeps, burn_in=None, J=1):
+    """
+    Runs one checkerboard simulation and returns its row of the sweep table.
+    `seed` may be anything accepted by np.random.default_rng, including a SeedSequence.
+    """
+    burn_in = n_sweeps // 5 if burn_in is None else burn_in
+    _, E, M = _checkerboard_series(N, n_sweeps, beta, J, seed)
+
+    E, M = E[burn_in:], M[burn_in:]
+    return {"magnetization": np.mean(np.abs(M)) / N**2,
+            "energy": np.mean(E) / N**2,
+            "tau_energy": integrated_autocorr(E),
+            "tau_magnetization": integrated_autocorr(np.abs(M))}
+
+
+def _sweep_task(key, seq, n_sweeps, burn_in, J):
+    beta, N, seed = key
+    row = {"beta": beta, "N": N, "seed": seed}
+    row.update(ising_point(beta, N, seq, n_sweeps, burn_in, J))
+    # the run settings go into the checkpoint, so a resume can check them
+    row.update({"n_sweeps": n_sweeps, "burn_in": burn_in, "J": J})
+    return row
+
+
+def ising_sweep(betas, sizes, seeds, n_sweeps, burn_in=None, J=1,
+                max_workers=None, checkpoint=None):
+    """
+    Runs the checkerboard engine over every (beta, N, seed) in the grid on a process
+    pool and returns one row per point. Each point draws from its own stream, spawned
+    from `seed` and keyed by the values of beta (its float64 bits) and N, so results
+    do not depend on scheduling, on the order of `betas` or on how the sweep was split
+    across resumes.
+
+    With `checkpoint` set to a csv path, rows are appended as they finish and points
+    already in the file are skipped, so an interrupted sweep picks up where it left off.
+    The file also records n_sweeps, burn_in and J, and resuming with different
+    settings raises a ValueError.
+    """
+    odd = [N for N in sizes if N % 2]
+    if odd:
+        raise ValueError("checkerboard updates need even lattices, got N=%s" % odd)
+    burn_in = n_sweeps // 5 if burn_in is None else burn_in
+    points = {}
+    for beta in betas:
+        bits = int(np.float64(beta).view(np.uint64))
+        for N in sizes:
+            for seed in seeds:
+                seq = np.random.SeedSequence(seed, spawn_key=(bits, N))
+                points[(float(beta), int(N), int(seed))] = seq
+
+    rows = []
+    if checkpoint is not None and os.path.exists(checkpoint):
+        done = pd.read_csv(checkpoint, float_precision="round_trip")
+        settings = {"n_sweeps": n_sweeps, "burn_in": burn_in, "J": J}
+        for name, value in settings.items():
+            if name not in done or (done[name] != value).any():
+                raise ValueError("checkpoint %s was not written with %s=%r"
+                                 % (checkpoint, name, value))
+        for row in done.to_dict("records"):
+            # rows outside the current grid are left in the file but not returned
+            if points.pop((row["beta"], row["N"], row["seed"]), None) is not None:
+                rows.append(row)
+
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(_sweep_task, key, seq, n_sweeps, burn_in, J)
+                   for key, seq in points.items()]
+        for future in as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            if checkpoint is not None:
+                header = not os.path.exists(checkpoint)
+                pd.DataFrame([row]).to_csv(checkpoint, mode="a", header=header, index=False)
+
+    table = pd.DataFrame(rows, columns=["beta", "N", "seed", "magnetization", "energy",
+                                        "tau_energy", "tau_magnetization"])
+    return table.sort_values(["N", "beta", "seed"]).reset_index(drop=True)
+
+
+def task_9():
+    # the magnetization curve of task 6, over all cores and averaged over 4 seeds
+    table = ising_sweep(np.linspace(0.1, 0.6, 50), [20], range(4), 2000)
+    curve = table.groupby("beta")["magnetization"].agg(["mean", "std"])
+
+    fig = plt.figure(figsize=(13,5))
+    plt.errorbar(curve.index, curve["mean"], curve["std"], fmt="g*")
+    plt.xlabel(r"$\beta$")
+    plt.ylabel(r"$|M|$")
+    plt.show()
+
+
+# task 10: parallel tempering
+def parallel_tempering(N, betas, n_sweeps, swap_every=1, J=1, rng=None, n_block=8):
+    """
+    Replica exchange: R = len(betas) lattices are swept together as one (R, N, N)
+    array, and every `swap_every` sweeps neighbouring temperatures propose to swap
+    configurations, alternating between even and odd pairs.
+
+    Returns the lattices (ordered as `betas`), the energy at each beta per sweep
+    (n_sweeps, R) and the swap acceptance rate of each neighbouring pair (R-1,).
+    """
+    if N % 2:
+        raise ValueError("checkerboard updates need an even lattice, got N=%d" % N)
+    rng = np.random.default_rng(rng)
+    betas = np.asarray(betas, dtype=float)
+    R = len(betas)
+    spins = rng.choice(np.array([-1, 1], dtype=np.int8), size=(R, N, N))
+    table = acceptance_table(betas, J)
+    masks = checkerboard_masks(N)
+    rand = uniform_buffer((R, N, N), n_block, rng)
+
+    E = np.array([total_mag_e(c, J) for c in spins], dtype=float)
+    E_series = np.ones((n_sweeps, R))
+    E_series[0] = E
+    attempts = np.zeros(R - 1)
+    accepts = np.zeros(R - 1)
+
+    for s in range(1, n_sweeps):
+        dE, _ = checkerboard_sweep(spins, table, J, masks, next(rand))
+        E += dE
+        if s % swap_every == 0:
+            # pairs (0,1),(2,3)... then (1,2),(3,4)...
+            pairs = np.arange((s // swap_every) % 2, R - 1, 2)
+            # accept with min(1, exp((b_lo - b_hi)(E_lo - E_hi)))
+            log_p = (betas[pairs] - betas[pairs+1]) * (E[pairs] - E[pairs+1])
+            ok = np.log(rng.random(len(pairs))) < log_p
+            lo, hi = pairs[ok], pairs[ok] + 1
+            spins[np.r_[lo, hi]] = spins[np.r_[hi, lo]]
+            E[np.r_[lo, hi]] = E[np.r_[hi, lo]]
+            attempts[pairs] += 1
+            accepts[lo] += 1
+        E_series[s] = E
+
+    return spins, E_series, accepts / np.maximum(attempts, 1)
+
+
+def task_10():
+    betas = np.linspace(0.3, 0.6, 16)
+    C, E, rates = parallel_tempering(40, betas, 5000)
+
+    fig,ax=plt.subplots(ncols=3, figsize=(16,4))
+    ax[0].plot(E[:, ::5])
+    ax[0].set_xlabel("sweeps")
+    ax[0].set_ylabel(r"Energy $E$")
+    ax[1].plot(.5*(betas[1:] + betas[:-1]), rates, "kx-")
+    ax[1].set_xlabel(r"$\beta$")
+    ax[1].set_ylabel("swap acceptance")
+    ax[2].imshow(C[-1], cmap="gray")
+    plt.show()
@@ -129,4 +129,278 @@ def task_6():
     plt.loglog(1 / N, E, 'x-')
     plt.xlabel(r"$\log 1/N$")
     plt.ylabel(r"$\log E$")
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+# task 7: all paths at once
+def sde_em_step(X, t, dt, dW, drift, diffusion, dZ=None):
+    # euler_maruyama_step for any vectorized drift f(X, t) and diffusion g(X, t)
+    return X + drift(X, t)*dt + diffusion(X, t)*dW
+
+
+def sde_milstein_step(X, t, dt, dW, drift, diffusion, dZ=None):
+    """
+    Milstein step (strong order 1) in its derivative-free form, where g g' is replaced
+    by a difference of g at a supporting value (Kloeden & Platen 11.1.3).
+    """
+    sq = np.sqrt(dt)
+    f, g = drift(X, t), diffusion(X, t)
+    g_s = diffusion(X + f*dt + g*sq, t)
+    return X + f*dt + g*dW + (g_s - g) * (dW**2 - dt) / (2.*sq)
+
+
+def sde_taylor15_step(X, t, dt, dW, drift, diffusion, dZ):
+    """
+    Explicit strong order 1.5 step (Kloeden & Platen 11.2.19), derivative-free. Needs the
+    double integral dZ = int int dW ds, drawn with dW by draw_increments(double=True).
+    The scheme is derived for autonomous coefficients; f and g are evaluated at the
+    step's t.
+    """
+    sq = np.sqrt(dt)
+    f, g = drift(X, t), diffusion(X, t)
+    Y_p = X + f*dt + g*sq
+    Y_m = X + f*dt - g*sq
+    g_p, g_m = diffusion(Y_p, t), diffusion(Y_m, t)
+    P_p = Y_p + g_p*sq
+    P_m = Y_p - g_p*sq
+    return X + g*dW \
+        + (drift(Y_p, t) - drift(Y_m, t)) * dZ / (2.*sq) \
+        + (drift(Y_p, t) + 2.*f + drift(Y_m, t)) * dt / 4. \
+        + (g_p - g_m) * (dW**2 - dt) / (4.*sq) \
+        + (g_p - 2.*g + g_m) * (dW*dt - dZ) / (2.*dt) \
+        + (diffusion(P_p, t) - diffusion(P_m, t) - g_p + g_m) * (dW**2/3. - dt) * dW / (4.*dt)
+
+
+SDE_SCHEMES = {"euler": sde_em_step,
+               "milstein": sde_milstein_step,
+               "taylor1.5": sde_taylor15_step}
+
+
+def draw_increments(rng, dt, size, double=False):
+    # dW of one step and, only if `double`, the correlated dZ = int int dW ds, so the
+    # lower order schemes draw one normal per step
+    U1 = rng.standard_normal(size)
+    if not double:
+        return np.sqrt(dt) * U1, None
+    U2 = rng.standard_normal(size)
+    return np.sqrt(dt) * U1, .5 * dt**1.5 * (U1 + U2/np.sqrt(3.))
+
+
+# paths sharing one random stream in sde_paths
+PATH_BLOCK = 1024
+
+
+def sde_paths(drift, diffusion, X_0, T, N, R, every=1, output="paths", chunk=10**4,
+              scheme="euler", rng=None):
+    """
+    Simulates R paths of dX = f(X, t) dt + g(X, t) dW on [0, T] with N steps of
+    `scheme` ("euler", "milstein" or "taylor1.5"). All paths of a chunk of `chunk` paths
+    advance together, one vectorized step per timestep.
+
+    Only every `every`-th time is recorded, and `output` sets what is kept of it:
+    "paths" (R, len(t)) values, "terminal" the (R,) values at T only, or "moments" the
+    mean and variance over paths at each recorded time, which never holds more than
+    one chunk of paths. Returns t and the output.
+
+    Paths are grouped in blocks of PATH_BLOCK, each drawing from its own Generator
+    spawned from `rng` (a seed, SeedSequence or Generator), and `chunk` is rounded up
+    to whole blocks, so the paths of a given seed do not depend on `chunk`.
+    """
+    n_blocks = -(-R // PATH_BLOCK)
+    if isinstance(rng, np.random.Generator):
+        streams = rng.spawn(n_blocks)
+    else:
+        seq = rng if isinstance(rng, np.random.SeedSequence) else np.random.SeedSequence(rng)
+        streams = [np.random.default_rng(s) for s in seq.spawn(n_blocks)]
+    chunk = max(1, -(-chunk // PATH_BLOCK)) * PATH_BLOCK
+    double = scheme == "taylor1.5"
+    step = SDE_SCHEMES[scheme]
+    dt = T / N
+    rec = np.array([N]) if output == "terminal" else np.arange(0, N+1, every)
+    t = rec * dt
+    if output in ("paths", "terminal"):
+        out = np.zeros((R, len(rec)))
+    elif output == "moments":
+        count, mean, M2 = 0, np.zeros(len(rec)), np.zeros(len(rec))
+    else:
+        raise ValueError("output must be 'paths', 'terminal' or 'moments', got %r" % output)
+
+    for start in range(0, R, chunk):
+        r = min(chunk, R - start)
+        X = np.full(r, X_0, dtype=np.float64)
+        Xr = np.zeros((r, len(rec)))
+        k = 0
+        for n in range(N+1):
+            if k < len(rec) and rec[k] == n:
+                Xr[:, k] = X
+                k += 1
+            if n < N:
+                draws = [draw_increments(streams[b], dt, min(PATH_BLOCK, R - b*PATH_BLOCK),
+                                         double)
+                         for b in range(start // PATH_BLOCK, -(-(start + r) // PATH_BLOCK))]
+                dW = np.concatenate([d[0] for d in draws])
+                dZ = np.concatenate([d[1] for d in draws]) if double else None
+                X = step(X, n*dt, dt, dW, drift, diffusion, dZ)
+
+        if output == "moments":
+            # merge this chunk's moments into the running ones
+            m = Xr.mean(axis=0)
+            d = m - mean
+            total = count + r
+            mean = mean + d * r / total
+            M2 = M2 + np.sum((Xr - m)**2, axis=0) + d**2 * count * r / total
+            count = total
+        else:
+            out[start:start+r] = Xr
+
+    if output == "moments":
+        return t, (mean, M2 / max(count - 1, 1))
+    if output == "terminal":
+        return t, out[:, 0]
+    return t, out
+
+
+def task_7():
+    lamda, mu = 2., 1.
+    t, (m, v) = sde_paths(lambda X, t: lamda*X, lambda X, t: mu*X, 1., 1., 1000, 10**5,
+                          every=10, output="moments")
+    plt.plot(t, m, 'k-', label="mean of paths")
+    plt.fill_between(t, m - np.sqrt(v), m + np.sqrt(v), color='r', alpha=.3)
+    plt.plot(t, np.exp(lamda*t), 'b--', label="expected")
+    plt.legend()
+    plt.xlabel(r"$t$")
+    plt.ylabel(r"$X$")
+    plt.show()
+
+
+# task 8: lazy paths
+def gbm_em_dask(dW, dt, lamda=2., mu=1., X_0=1.):
+    """
+    Euler-Maruyama for dX = lamda X dt + mu X dW straight from chunked increments dW
+    (R, N): each step multiplies by 1 + lamda dt + mu dW_n, so the paths are a
+    cumulative product scan along time and never leave the graph. Column n is X at
+    t = (n+1) dt.
+    """
+    return X_0 * da.cumprod(1. + lamda*dt + mu*dW, axis=1)
+
+
+def gbm_exact_dask(dW, dt, lamda=2., mu=1., X_0=1.):
+    # exact solution on the same Brownian path, at the same times as gbm_em_dask
+    W = da.cumsum(dW, axis=1)
+    t = dt * da.arange(1, dW.shape[1] + 1, chunks=dW.chunks[1])
+    return X_0 * da.exp((lamda - .5*mu**2) * t + mu*W)
+
+
+def _sde_block(dW, X_0, dt, drift, diffusion):
+    X = np.empty_like(dW)
+    x = np.full(dW.shape[0], X_0, dtype=dW.dtype)
+    for n in range(dW.shape[1]):
+        x = sde_em_step(x, n*dt, dt, dW[:, n], drift, diffusion)
+        X[:, n] = x
+    return X
+
+
+def sde_dask(drift, diffusion, X_0, dW, dt):
+    """
+    Euler-Maruyama for any vectorized drift and diffusion on chunked increments dW
+    (R, N). Blocks hold whole paths (time is rechunked to one chunk) and run the
+    vectorized step over their paths, so only one block of paths is ever in memory.
+    Column n is X at t = (n+1) dt.
+    """
+    dW = dW.rechunk({1: -1})
+    return dW.map_blocks(_sde_block, X_0, dt, drift, diffusion, dtype=dW.dtype)
+
+
+def task_8():
+    # task 6 without leaving the graph: only the error comes back to the driver
+    N = np.logspace(2, 5, 6, dtype=np.int_)
+    E = np.zeros(len(N))
+    R = 1000
+    for i, n in enumerate(N):
+        dt = 1. / n
+        dW = da.random.normal(0, np.sqrt(dt), size=(R, n), chunks=(R//4, max(n//4, 1)))
+        X = gbm_em_dask(dW, dt)
+        X_exact = gbm_exact_dask(dW, dt)
+        # strong error at T=1
+        E[i] = da.mean(da.fabs(X[:, -1] - X_exact[:, -1])).compute()
+
+    plt.loglog(1 / N, E, 'x-')
+    plt.xlabel(r"$\log 1/N$")
+    plt.ylabel(r"$\log E$")
+    plt.show()
+
+
+# task 9: higher order and adaptive steps
+def sde_adaptive(drift, diffusion, X_0, T, R, tol, scheme="milstein", dt0=None, dt_min=None,
+                 rng=None):
+    """
+    Simulates R paths on a shared adaptive time grid. Each step of size h is compared
+    with two steps of h/2, the midpoint of the Brownian path drawn from the Brownian
+    bridge given the step's increment. If the largest difference over paths exceeds
+    `tol` the step is refined into its two bridged halves, so the path being
+    simulated never changes; after easy steps h doubles.
+
+    Only "euler" and "milstein" are supported, as "taylor1.5" would also need dZ to be
+    bridged. Returns the accepted times and the paths (R, len(t)).
+    """
+    if scheme not in ("euler", "milstein"):
+        raise ValueError("adaptive steps support 'euler' and 'milstein', got %r" % scheme)
+    rng = np.random.default_rng(rng)
+    step = SDE_SCHEMES[scheme]
+    h_next = T / 100. if dt0 is None else dt0
+    dt_min = T * 1e-6 if dt_min is None else dt_min
+
+    t = 0.
+    X = np.full(R, X_0, dtype=np.float64)
+    ts, Xs = [t], [X]
+    # increments still to be taken, the next one last
+    pending = []
+    while t < T * (1 - 1e-12):
+        if pending:
+            h, dW = pending.pop()
+        else:
+            h = min(h_next, T - t)
+            dW = np.sqrt(h) * rng.standard_normal(R)
+        dW1 = dW/2. + np.sqrt(h/4.) * rng.standard_normal(R)
+        dW2 = dW - dW1
+
+        full = step(X, t, h, dW, drift, diffusion)
+        half = step(step(X, t, h/2., dW1, drift, diffusion), t + h/2., h/2., dW2,
+                    drift, diffusion)
+        err = np.max(np.abs(full - half))
+        if err <= tol or h/2. < dt_min:
+            X = half
+            t += h
+            ts.append(t)
+            Xs.append(X)
+            h_next = 2.*h if err < tol/2. else h
+        else:
+            pending.append((h/2., dW2))
+            pending.append((h/2., dW1))
+    return np.array(ts), np.stack(Xs, axis=1)
+
+
+def task_9():
+    # strong error at T=1 against the exact GBM for each scheme
+    lamda, mu = 2., 1.
+    f = lambda X, t: lamda*X
+    g = lambda X, t: mu*X
+    R = 1000
+    Ns = np.logspace(1, 3, 5, dtype=np.int_)
+    rng = np.random.default_rng(0)
+    for name, step in SDE_SCHEMES.items():
+        E = np.zeros(len(Ns))
+        for i, n in enumerate(Ns):
+            dt = 1. / n
+            X = np.ones(R)
+            W = np.zeros(R)
+            for k in range(n):
+                dW, dZ = draw_increments(rng, dt, R, name == "taylor1.5")
+                X = step(X, k*dt, dt, dW, f, g, dZ)
+                W += dW
+            E[i] = np.mean(np.abs(X - np.exp((lamda - .5*mu**2) + mu*W)))
+        plt.loglog(1 / Ns, E, 'x-', label=name)
+    plt.xlabel(r"$\log 1/N$")
+    plt.ylabel(r"$\log E$")
+    plt.legend()
+    plt.show()
@@ -5,6 +5,9 @@ Created on Mon Jun  3 13:47:03 2019
 
 @author: gparkes
 """
+import os
+import json
+from numba import jit
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -13,6 +16,11 @@ def lennard_jones_potential(r):
     return 24. * (2. * (1 / r)**14 - (1 / r)**8)
 
 
+def lennard_jones_energy(r):
+    # the pair potential whose force gives lennard_jones_potential(r) * r
+    return 4. * ((1 / r)**12 - (1 / r)**6)
+
+
 # task 2
 def acceleration(x, L, Rc):
     a = np.zeros_like(x)
@@ -32,13 +40,14 @@ def acceleration(x, L, Rc):
 
 
 # task 3
-def verlet(x, v, a, dt, L):
+def verlet(x, v, a, dt, L, accel=None):
+    # accel(x) replaces the default acceleration(x, L, 2.5), e.g. a NeighbourList
     x = x + dt*v + .5*dt**2 * a
     # boundary check
     x[x < 0] += L
     x[x > L] -= L
     vstar = v + .5*dt*a
-    a = acceleration(x, L, 2.5)
+    a = acceleration(x, L, 2.5) if accel is None else accel(x)
     v = vstar + .5*dt*a
     return x, v, a
 
@@ -67,11 +76,9 @@ def task_4():
 
 # task 5
 def calc_temperature(v, L):
-    E = np.zeros((len(v)))
-    # loop
-    for particle in range(len(v)):
-        E[particle] = .5*(L**2)*(np.linalg.norm(v[particle]))**2
-    return np.sum(E) * (2. / (3. * len(E)))
+    # T = 2 KE / 3n in reduced units, the same velocities as kinetic_energy and
+    # pressure (L is unused); v may also be a stack of frames (k, n, 3)
+    return 2. * kinetic_energy(v) / (3. * v.shape[-2])
 
 
 def task_5():
@@ -98,3 +105,548 @@ def task_5():
     ax.set_xlabel("time t")
     ax.set_ylabel("Temperature T")
     plt.show()
+
+
+# task 6: cell and neighbour lists
+@jit(nopython=True)
+def _linked_cells(x, L, nc):
+    n = x.shape[0]
+    size = L / nc
+    # linked cells: head[c] is the first particle of cell c, nxt[i] the one after i
+    head = -np.ones(nc**3, dtype=np.int64)
+    nxt = -np.ones(n, dtype=np.int64)
+    cell = np.empty((n, 3), dtype=np.int64)
+    for i in range(n):
+        for d in range(3):
+            cell[i, d] = int(x[i, d] / size) % nc
+        c = (cell[i, 0]*nc + cell[i, 1])*nc + cell[i, 2]
+        nxt[i] = head[c]
+        head[c] = i
+    # with fewer than 3 cells per side the offsets -1 and +1 reach the same cell,
+    # so each distinct neighbour cell is visited once: offsets run over range(lo, hi)
+    lo = -1 if nc > 2 else 0
+    hi = 2 if nc > 1 else 1
+    return head, nxt, cell, lo, hi
+
+
+@jit(nopython=True)
+def _cell_pairs(x, L, r_list, nc):
+    n = x.shape[0]
+    head, nxt, cell, lo, hi = _linked_cells(x, L, nc)
+
+    # count the pairs, then fill them
+    I = np.empty(0, dtype=np.int64)
+    J = np.empty(0, dtype=np.int64)
+    for fill in range(2):
+        count = 0
+        for i in range(n):
+            for ox in range(lo, hi):
+                for oy in range(lo, hi):
+                    for oz in range(lo, hi):
+                        c = (((cell[i, 0]+ox) % nc)*nc + (cell[i, 1]+oy) % nc)*nc \
+                            + (cell[i, 2]+oz) % nc
+                        j = head[c]
+                        while j != -1:
+                            if j > i:
+                                r2 = 0.
+                                for d in range(3):
+                                    dx = x[i, d] - x[j, d]
+                                    dx -= L * np.round(dx / L)
+                                    r2 += dx*dx
+                                if r2 < r_list*r_list:
+                                    if fill:
+                                        I[count] = i
+                                        J[count] = j
+                                    count += 1
+                            j = nxt[j]
+        if not fill:
+            I = np.empty(count, dtype=np.int64)
+            J = np.empty(count, dtype=np.int64)
+    return I, J
+
+
+@jit(nopython=True)
+def _cell_histogram(x, L, r_max, nc, bins):
+    # pair distances below r_max binned straight into `bins` equal bins, no pair list
+    n = x.shape[0]
+    head, nxt, cell, lo, hi = _linked_cells(x, L, nc)
+    counts = np.zeros(bins, dtype=np.int64)
+    for i in range(n):
+        for ox in range(lo, hi):
+            for oy in range(lo, hi):
+                for oz in range(lo, hi):
+                    c = (((cell[i, 0]+ox) % nc)*nc + (cell[i, 1]+oy) % nc)*nc \
+                        + (cell[i, 2]+oz) % nc
+                    j = head[c]
+                    while j != -1:
+                        if j > i:
+                            r2 = 0.
+                            for d in range(3):
+                                dx = x[i, d] - x[j, d]
+                                dx -= L * np.round(dx / L)
+                                r2 += dx*dx
+                            if r2 < r_max*r_max:
+                                counts[min(int(np.sqrt(r2) / r_max * bins), bins - 1)] += 1
+                        j = nxt[j]
+    return counts
+
+
+def neighbour_pairs(x, L, r_list):
+    """
+    All pairs i < j of 3-d particles within r_list under the minimum image, from a
+    linked-cell grid with cells at least r_list wide, so only the 27 surrounding cells
+    are searched: O(n) for a fixed density. Cutoffs above L/3 leave fewer cells and
+    the search tends to all pairs, but only the pairs found are stored.
+    """
+    nc = max(int(L // r_list), 1)
+    return _cell_pairs(np.ascontiguousarray(x, dtype=np.float64), float(L), float(r_list), nc)
+
+
+def pair_acceleration(x, L, I, J, Rc, full_output=False):
+    # acceleration from a list of candidate pairs, all pairs at once; with full_output
+    # the potential energy and virial of the same pairs are also returned
+    dx = x[I] - x[J]
+    dx -= L * np.round(dx / L)
+    r2 = np.einsum("ij,ij->i", dx, dx)
+    inside = r2 < Rc**2
+    I, J, dx = I[inside], J[inside], dx[inside]
+    r = np.sqrt(r2[inside])
+    phi = lennard_jones_potential(r)
+    f = dx * phi[:, None]
+    a = np.zeros_like(x)
+    for d in range(x.shape[1]):
+        a[:, d] = np.bincount(I, f[:, d], minlength=len(x)) - \
+            np.bincount(J, f[:, d], minlength=len(x))
+    if not full_output:
+        return a
+    return a, np.sum(lennard_jones_energy(r)), np.sum(phi * r**2)
+
+
+class NeighbourList(object):
+    """
+    Verlet neighbour list: pairs within Rc + skin, rebuilt from the cell grid only once
+    some particle has moved more than skin/2 since the last build, as until then no
+    pair outside the list can have come within Rc.
+    """
+
+    def __init__(self, L, Rc=2.5, skin=.3):
+        self.L = L
+        self.Rc = Rc
+        self.skin = skin
+        self.x_ref = None
+        self.builds = 0
+
+    def build(self, x):
+        self.x_ref = x.copy()
+        self.I, self.J = neighbour_pairs(x, self.L, self.Rc + self.skin)
+        self.builds += 1
+
+    def update(self, x):
+        if self.x_ref is None:
+            return self.build(x)
+        dx = x - self.x_ref
+        dx -= self.L * np.round(dx / self.L)
+        if np.max(np.einsum("ij,ij->i", dx, dx)) > (self.skin / 2)**2:
+            self.build(x)
+
+    def acceleration(self, x):
+        self.update(x)
+        return pair_acceleration(x, self.L, self.I, self.J, self.Rc)
+
+
+def lattice(n_side, L):
+    # n_side**3 particles on a cubic lattice filling the box
+    g = (np.arange(n_side) + .5) * L / n_side
+    return np.stack(np.meshgrid(g, g, g, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+def task_6():
+    # 10^5 particles at reduced density 0.8
+    n_side = 47
+    L = n_side / .8**(1/3)
+    x = lattice(n_side, L)
+    v = np.random.normal(0, .1, size=x.shape)
+    nlist = NeighbourList(L, 2.5, .3)
+    a = nlist.acceleration(x)
+    dt = 0.005
+    steps = 100
+    T = np.zeros(steps)
+    for i in range(steps):
+        x, v, a = verlet(x, v, a, dt, L, accel=nlist.acceleration)
+        T[i] = calc_temperature(v, L)
+
+    plt.plot(np.arange(steps)*dt, T, 'k-')
+    plt.xlabel("time t")
+    plt.ylabel("Temperature T")
+    plt.title("%d particles, %d neighbour list builds" % (len(x), nlist.builds))
+    plt.show()
+
+
+# task 7: blocked all-pairs kernel
+def acceleration_tiled(x, L, Rc, tile=128):
+    """
+    All-pairs acceleration in tile x tile blocks, so the (tile, tile, p) displacements
+    stay in cache instead of forming an n x n x p temporary. Only blocks j >= i are
+    visited and each pair force is added to both particles (Newton's third law).
+
+    Returns the acceleration together with the potential energy and the virial
+    sum_ij r_ij . F_ij of the same pairs.
+    """
+    n = len(x)
+    a = np.zeros_like(x)
+    U = 0.
+    W = 0.
+    for i0 in range(0, n, tile):
+        xi = x[i0:i0+tile]
+        for j0 in range(i0, n, tile):
+            xj = x[j0:j0+tile]
+            dx = xi[:, None, :] - xj[None, :, :]
+            dx -= L * np.round(dx / L)
+            r2 = np.einsum("ijk,ijk->ij", dx, dx)
+            mask = r2 < Rc**2
+            if j0 == i0:
+                # each pair once: j > i
+                mask &= np.triu(np.ones(mask.shape, dtype=bool), k=1)
+            inv2 = np.divide(1., r2, out=np.zeros_like(r2), where=mask)
+            inv6 = inv2**3
+            # lennard_jones_potential in powers of 1/r^2
+            phi = 24. * (2.*inv6*inv6 - inv6) * inv2
+            a[i0:i0+tile] += np.einsum("ij,ijk->ik", phi, dx)
+            a[j0:j0+tile] -= np.einsum("ij,ijk->jk", phi, dx)
+            U += 4. * np.sum(inv6*inv6 - inv6)
+            W += np.sum(phi * r2)
+    return a, U, W
+
+
+def task_7():
+    # the tiled kernel against the loop of task 2, then a short run using it
+    n_side = 6
+    L = n_side / .8**(1/3)
+    x = lattice(n_side, L) + np.random.normal(0, .05, size=(n_side**3, 3))
+    x %= L
+    a, U, W = acceleration_tiled(x, L, 2.5, tile=64)
+    print("max |a_tiled - a| =", np.max(np.abs(a - acceleration(x, L, 2.5))))
+    print("U = %.4f, W = %.4f, P = %.4f" % (U, W, pressure(np.zeros_like(x), L, W)))
+
+    system = MDSystem(x, np.random.normal(0, .1, size=x.shape), L, 0.005, tiled=True)
+    E = np.zeros(200)
+    for i in range(len(E)):
+        system.advance()
+        E[i] = kinetic_energy(system.v) + system.potential_energy()
+    plt.plot(np.arange(len(E))*system.dt, E, 'k-')
+    plt.xlabel("time t")
+    plt.ylabel("total energy")
+    plt.show()
+
+
+# task 8: long runs
+class MDSystem(object):
+    """
+    State of a Lennard-Jones run: positions, velocities and accelerations, advanced by
+    verlet with forces from a NeighbourList or, with tiled=True, from the blocked
+    all-pairs kernel acceleration_tiled. Either force pass also returns the potential
+    energy and virial, which are kept for thermo and pressure.
+    """
+
+    def __init__(self, x, v, L, dt, Rc=2.5, skin=.3, step=0, tiled=False):
+        self.L = L
+        self.dt = dt
+        self.Rc = Rc
+        self.tiled = tiled
+        self.nlist = NeighbourList(L, Rc, skin)
+        self.reset(x, v, step)
+
+    def reset(self, x, v, step):
+        self.x = np.array(x, dtype=np.float64)
+        self.v = np.array(v, dtype=np.float64)
+        self.a = self.forces(self.x)
+        self.step = step
+
+    def forces(self, x):
+        # acceleration at x, the accel= of verlet
+        if self.tiled:
+            a, self.U, self.W = acceleration_tiled(x, self.L, self.Rc)
+        else:
+            self.nlist.update(x)
+            a, self.U, self.W = pair_acceleration(x, self.L, self.nlist.I, self.nlist.J,
+                                                  self.Rc, full_output=True)
+        return a
+
+    def advance(self):
+        self.x, self.v, self.a = verlet(self.x, self.v, self.a, self.dt, self.L,
+                                        accel=self.forces)
+        self.step += 1
+
+    def pair_sums(self):
+        # potential energy and virial of the current positions, from the last force pass
+        return self.U, self.W
+
+    def potential_energy(self):
+        return self.pair_sums()[0]
+
+    def pressure(self):
+        return pressure(self.v, self.L, self.pair_sums()[1])
+
+    def thermo(self):
+        # step, temperature, kinetic and potential energy
+        return (self.step, calc_temperature(self.v, self.L), kinetic_energy(self.v),
+                self.potential_energy())
+
+
+class TrajectoryWriter(object):
+    """
+    Trajectory on disk as a directory of chunk files, each holding `chunk` frames of
+    positions and velocities (chunk, n, 3) and thermodynamics (chunk, 4), filled in
+    place through np.lib.format.open_memmap. meta.json records how many frames are
+    complete and is rewritten (atomically) every `flush_every` frames, so after an
+    interruption the directory can be reopened and appended to from the last frame.
+    """
+
+    def __init__(self, path, n, chunk=1000, flush_every=10):
+        self.path = path
+        self.n = n
+        self.chunk = chunk
+        self.flush_every = flush_every
+        self.frames = 0
+        self._open_chunk = None
+        os.makedirs(path, exist_ok=True)
+        meta = os.path.join(path, "meta.json")
+        if os.path.exists(meta):
+            with open(meta) as f:
+                info = json.load(f)
+            if info["n"] != n or info["chunk"] != chunk:
+                raise ValueError("%s holds a trajectory with n=%d, chunk=%d" %
+                                 (path, info["n"], info["chunk"]))
+            self.frames = info["frames"]
+
+    def _file(self, name, k):
+        return os.path.join(self.path, "%s_%05d.npy" % (name, k))
+
+    def _arrays(self, k):
+        if self._open_chunk is not None and self._open_chunk[0] == k:
+            return self._open_chunk[1]
+        shapes = {"positions": (self.chunk, self.n, 3),
+                  "velocities": (self.chunk, self.n, 3),
+                  "thermo": (self.chunk, 4)}
+        arrays = {}
+        for name, shape in shapes.items():
+            f = self._file(name, k)
+            if os.path.exists(f):
+                arrays[name] = np.lib.format.open_memmap(f, mode="r+")
+            else:
+                arrays[name] = np.lib.format.open_memmap(f, mode="w+", dtype=np.float64,
+                                                         shape=shape)
+        self.flush()
+        self._open_chunk = (k, arrays)
+        return arrays
+
+    def write(self, x, v, thermo):
+        k, i = divmod(self.frames, self.chunk)
+        arrays = self._arrays(k)
+        arrays["positions"][i] = x
+        arrays["velocities"][i] = v
+        arrays["thermo"][i] = thermo
+        self.frames += 1
+        if self.frames % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if self._open_chunk is not None:
+            for array in self._open_chunk[1].values():
+                array.flush()
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"n": self.n, "chunk": self.chunk, "frames": self.frames}, f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def close(self):
+        self.flush()
+        self._open_chunk = None
+
+    def last_frame(self):
+        # (step, positions, velocities) of the last complete frame
+        k, i = divmod(self.frames - 1, self.chunk)
+        arrays = self._arrays(k)
+        return int(arrays["thermo"][i, 0]), np.array(arrays["positions"][i]), \
+            np.array(arrays["velocities"][i])
+
+
+def trajectory_chunks(path):
+    """
+    Yields (thermo, positions, velocities) of a written trajectory one chunk file at a
+    time, memory-mapped read-only, so analysis never loads the whole run.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        info = json.load(f)
+    for k in range(-(-info["frames"] // info["chunk"])):
+        used = min(info["chunk"], info["frames"] - k*info["chunk"])
+        load = lambda name: np.load(os.path.join(path, "%s_%05d.npy" % (name, k)),
+                                    mmap_mode="r")[:used]
+        yield load("thermo"), load("positions"), load("velocities")
+
+
+def run_md(system, steps, stride=10, writer=None):
+    """
+    Advances `system` with verlet until it reaches step `steps`, recording a frame and
+    its thermodynamics every `stride` steps. Frames go to `writer` (a TrajectoryWriter)
+    rather than memory; if the writer already holds frames the run restarts from the
+    last one. Returns the recorded thermodynamics (step, T, KE, PE) as an array.
+    """
+    thermo = []
+
+    def record():
+        row = system.thermo()
+        thermo.append(row)
+        if writer is not None:
+            writer.write(system.x, system.v, row)
+
+    if writer is not None and writer.frames:
+        step, x, v = writer.last_frame()
+        system.reset(x, v, step)
+    else:
+        record()
+    try:
+        while system.step < steps:
+            system.advance()
+            if system.step % stride == 0:
+                record()
+    finally:
+        if writer is not None:
+            writer.close()
+    return np.array(thermo)
+
+
+def task_8():
+    n_side = 10
+    L = n_side / .8**(1/3)
+    x = lattice(n_side, L)
+    v = np.random.normal(0, .1, size=x.shape)
+    system = MDSystem(x, v, L, 0.005)
+    writer = TrajectoryWriter("md_run", len(x), chunk=100)
+    # rerunning resumes from the last frame on disk
+    run_md(system, 2000, stride=10, writer=writer)
+
+    fig = plt.figure(figsize=(14,8))
+    ax = fig.add_subplot(121)
+    ax2 = fig.add_subplot(122)
+    for thermo, pos, _ in trajectory_chunks("md_run"):
+        ax.plot(thermo[:, 0]*system.dt, thermo[:, 1], 'k-')
+        ax2.scatter(pos[:, 0, 0], pos[:, 0, 1], s=2)
+    ax.set_xlabel("time t")
+    ax.set_ylabel("Temperature T")
+    plt.show()
+
+
+# task 9: observables
+def kinetic_energy(v):
+    # unit masses; v may also be a stack of frames (k, n, 3)
+    return .5 * np.sum(v*v, axis=(-2, -1))
+
+
+def pressure(v, L, virial):
+    """
+    Virial pressure P = (sum m v^2 + sum r_ij . F_ij) / 3V, with the virial as returned
+    by acceleration_tiled or MDSystem.pair_sums.
+    """
+    return (np.sum(v*v, axis=(-2, -1)) + virial) / (3. * L**3)
+
+
+class RDFAccumulator(object):
+    """
+    Radial distribution function g(r) up to r_max (at most L/2), accumulated one frame
+    at a time: pair distances are binned inside the cell-list search, so neither a pair
+    list nor the displacements are stored and only the histogram is kept between
+    frames. A cutoff of a few sigma leaves enough cells for the search to prune.
+    """
+
+    def __init__(self, L, n, r_max, bins=100):
+        self.L = L
+        self.n = n
+        self.r_max = r_max
+        self.edges = np.linspace(0, r_max, bins + 1)
+        self.counts = np.zeros(bins)
+        self.frames = 0
+
+    def update(self, x):
+        nc = max(int(self.L // self.r_max), 1)
+        self.counts += _cell_histogram(np.ascontiguousarray(x, dtype=np.float64),
+                                       float(self.L), float(self.r_max), nc,
+                                       len(self.counts))
+        self.frames += 1
+
+    def result(self):
+        r = .5 * (self.edges[1:] + self.edges[:-1])
+        shell = 4./3. * np.pi * (self.edges[1:]**3 - self.edges[:-1]**3)
+        # pairs are counted once, so an ideal gas gives n(n-1)/2 * shell / V per frame
+        ideal = .5 * self.n * (self.n - 1) / self.L**3 * shell * max(self.frames, 1)
+        return r, self.counts / ideal
+
+
+class MSDAccumulator(object):
+    """
+    Mean-squared displacement from the first frame. Positions are unwrapped
+    incrementally from the minimum-image step between consecutive frames, which is
+    exact as long as no particle moves more than L/2 between frames.
+    """
+
+    def __init__(self, x0, L):
+        self.L = L
+        self.prev = np.array(x0, dtype=np.float64)
+        self.disp = np.zeros_like(self.prev)
+        self.msd = [0.]
+
+    def update(self, x):
+        dx = x - self.prev
+        dx -= self.L * np.round(dx / self.L)
+        self.disp += dx
+        self.prev[...] = x
+        self.msd.append(np.mean(np.sum(self.disp**2, axis=1)))
+
+    def result(self):
+        return np.array(self.msd)
+
+
+def analyse_trajectory(path, L, r_max=None, bins=100, rdf_every=10):
+    """
+    One streaming pass over a trajectory written by run_md: temperature and kinetic
+    energy of whole chunks at once, g(r) every `rdf_every` frames and the MSD of
+    every frame. g(r) extends to r_max, by default 3 sigma (capped at L/2). Returns a
+    dict of the results.
+    """
+    r_max = min(3., L / 2.) if r_max is None else r_max
+    rdf = msd = None
+    steps, T, KE = [], [], []
+    frame = 0
+    for thermo, pos, vel in trajectory_chunks(path):
+        steps.append(thermo[:, 0])
+        T.append(calc_temperature(vel, L))
+        KE.append(kinetic_energy(vel))
+        for x in pos:
+            if msd is None:
+                msd = MSDAccumulator(x, L)
+                rdf = RDFAccumulator(L, len(x), r_max, bins)
+            else:
+                msd.update(x)
+            if frame % rdf_every == 0:
+                rdf.update(x)
+            frame += 1
+
+    r, g = rdf.result()
+    return {"step": np.concatenate(steps), "T": np.concatenate(T),
+            "KE": np.concatenate(KE), "msd": msd.result(), "r": r, "g": g}
+
+
+def task_9():
+    # needs the run of task 8 on disk
+    n_side = 10
+    L = n_side / .8**(1/3)
+    res = analyse_trajectory("md_run", L)
+
+    fig, ax = plt.subplots(ncols=2, figsize=(14,5))
+    ax[0].plot(res["r"], res["g"], 'k-')
+    ax[0].set_xlabel(r"$r$")
+    ax[0].set_ylabel(r"$g(r)$")
+    ax[1].plot(res["step"], res["msd"], 'k-')
+    ax[1].set_xlabel("step")
+    ax[1].set_ylabel("MSD")
+    plt.show()
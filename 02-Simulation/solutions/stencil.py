@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:41 2026
+
+Periodic neighbour sums shared by the Ising model (04_solutions_2.py) and the Game of
+Life (03_solutions.py), for NumPy and Dask arrays.
+"""
+import time
+import tracemalloc
+from functools import partial
+import numpy as np
+from scipy import ndimage
+
+VON_NEUMANN = np.array([[0, 1, 0],
+                        [1, 0, 1],
+                        [0, 1, 0]])
+
+MOORE = np.array([[1, 1, 1],
+                  [1, 0, 1],
+                  [1, 1, 1]])
+
+
+_INT_TYPES = [np.dtype(t) for t in (np.uint8, np.int8, np.uint16, np.int16,
+                                     np.uint32, np.int32, np.uint64, np.int64)]
+
+
+def _default_dtype(x, kernel):
+    # integer kernels accumulate in the smallest integer type that holds the extreme
+    # weighted sums over the input's range; booleans count as 0/1
+    xt = np.dtype(np.uint8) if x.dtype == bool else x.dtype
+    if kernel.dtype.kind not in "iub" or xt.kind not in "iu":
+        return np.result_type(xt, kernel.dtype)
+    xmin, xmax = (0, 1) if x.dtype == bool else (int(np.iinfo(xt).min), int(np.iinfo(xt).max))
+    k = [int(w) for w in kernel.ravel()]
+    pos, neg = sum(w for w in k if w > 0), sum(w for w in k if w < 0)
+    lo, hi = pos*xmin + neg*xmax, pos*xmax + neg*xmin
+    for t in _INT_TYPES:
+        if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+            return t
+    # 64-bit inputs stay exact in 64 bits, trusting the values to be far from the
+    # type's bounds (as for int64 spins or 0/1 cells)
+    return np.dtype(np.int64 if lo < 0 else np.uint64)
+
+
+def _periodic_sum_numpy(x, kernel, out=None, dtype=None, method="views"):
+    ry, rx = kernel.shape[0] // 2, kernel.shape[1] // 2
+    H, W = x.shape[-2:]
+    dtype = _default_dtype(x, kernel) if dtype is None else dtype
+
+    if method == "ndimage":
+        # leading axes are batch axes, so the kernel gets singleton dimensions for them
+        k = kernel.reshape((1,) * (x.ndim - 2) + kernel.shape)
+        return ndimage.correlate(x.astype(dtype, copy=False), k, output=out, mode="wrap")
+    elif method != "views":
+        raise ValueError("unknown method %r, expected 'views' or 'ndimage'" % method)
+
+    # one wrapped copy, then every term is a view added in place into `out`
+    pad = [(0, 0)] * (x.ndim - 2) + [(ry, ry), (rx, rx)]
+    p = np.pad(x, pad, mode="wrap")
+    if np.result_type(p.dtype, dtype) != dtype:
+        # e.g. uint64 under a signed kernel, which NumPy would promote to float
+        p = p.astype(dtype)
+    if out is None:
+        out = np.zeros(x.shape, dtype=dtype)
+    else:
+        out[...] = 0
+    scratch = None
+    for (di, dj), w in np.ndenumerate(kernel):
+        if w == 0:
+            continue
+        view = p[..., di:di+H, dj:dj+W]
+        if w == 1:
+            np.add(out, view, out=out)
+        else:
+            if scratch is None:
+                scratch = np.empty_like(out)
+            # the weight takes the output type, so a negative weight on unsigned
+            # input promotes rather than wraps
+            np.multiply(view, out.dtype.type(w), out=scratch)
+            np.add(out, scratch, out=out)
+    return out
+
+
+def periodic_sum(x, kernel=MOORE, out=None, dtype=None, method="views"):
+    """
+    Weighted sum over the neighbours of every cell on a periodic grid, taken over the
+    last two axes of `x` (leading axes are treated as a batch):
+
+        out[..., i, j] = sum_ab kernel[a, b] * x[..., i + a - ry, j + b - rx]
+
+    `method` is "views" (accumulate shifted views of one wrapped copy in place) or
+    "ndimage" (scipy.ndimage.correlate in wrap mode). Unless `dtype` is given, integer
+    kernels accumulate in the smallest integer type wide enough for any input of x's
+    dtype (bool counts as 0/1), e.g. uint16 for a Moore sum of uint8 cells; 64-bit
+    integer inputs keep a 64-bit integer type. Dask arrays are handled with map_overlap, each block exchanging a
+    halo the size of the kernel radius.
+    """
+    kernel = np.asarray(kernel)
+    if hasattr(x, "map_overlap"):
+        ry, rx = kernel.shape[0] // 2, kernel.shape[1] // 2
+        depth = {ax: 0 for ax in range(x.ndim)}
+        depth[x.ndim - 2], depth[x.ndim - 1] = ry, rx
+        boundary = {ax: ("periodic" if d else "none") for ax, d in depth.items()}
+        dtype = _default_dtype(x, kernel) if dtype is None else dtype
+        # halos are already in each block, so wrapping inside a block only touches
+        # cells that map_overlap trims away
+        block_sum = partial(_periodic_sum_numpy, kernel=kernel, dtype=dtype, method=method)
+        return x.map_overlap(block_sum, depth=depth, boundary=boundary, dtype=dtype)
+    return _periodic_sum_numpy(x, kernel, out, dtype, method)
+
+
+def _roll_chain(x):
+    # the Moore sum as written in the original life_step_dask, for comparison
+    l_roll = np.roll(x, 1, axis=0)
+    r_roll = np.roll(x, -1, axis=0)
+    return l_roll + r_roll + np.roll(x, 1, axis=1) + np.roll(x, -1, axis=1) + \
+        np.roll(l_roll, 1, axis=1) + np.roll(l_roll, -1, axis=1) + \
+        np.roll(r_roll, 1, axis=1) + np.roll(r_roll, -1, axis=1)
+
+
+def _profile(f, *args, **kwargs):
+    tracemalloc.start()
+    t = time.perf_counter()
+    f(*args, **kwargs)
+    t = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return t, peak
+
+
+def benchmark(N=2048, dtype=np.uint8):
+    """
+    Time and peak allocation of a Moore neighbour sum on an N x N grid: the chain of
+    rolls used by life_step_dask against in-place view accumulation and ndimage.
+    """
+    x = np.random.randint(2, size=(N, N)).astype(dtype)
+    out = np.empty_like(x)
+    cases = [("roll chain", _roll_chain, (x,), {}),
+             ("views", periodic_sum, (x, MOORE), {}),
+             ("views, out=", periodic_sum, (x, MOORE), {"out": out}),
+             ("ndimage", periodic_sum, (x, MOORE), {"method": "ndimage"})]
+    print("%-12s %10s %12s" % ("method", "time (s)", "peak (MB)"))
+    for name, f, args, kwargs in cases:
+        t, peak = _profile(f, *args, **kwargs)
+        print("%-12s %10.4f %12.1f" % (name, t, peak / 2**20))
+
+
+if __name__ == "__main__":
+    benchmark()